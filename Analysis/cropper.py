@@ -1,12 +1,155 @@
+import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import xml.etree.ElementTree as ET
+
 import rasterio
+from rasterio.crs import CRS
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.io import MemoryFile
 from rasterio.mask import mask
+from rasterio.shutil import copy
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+from shapely import STRtree
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
 import fiona
 
-def clip_image(image_path, kml_path, output_path):
-    with fiona.open(kml_path, driver='KML') as kml:
-        geometries = [feat["geometry"] for feat in kml]
+# запас вокруг AOI в градусах, чтобы края не страдали от ресемплинга и ортокоррекции
+AOI_BUFFER_DEG = 0.01
+
+# предельный охват группы чипов, читаемой одним окном, в пикселях на канал
+GROUP_MAX_PIXELS = 2048 * 2048
+
+
+@lru_cache(maxsize=32)
+def _load_features(aoi_path, mtime_ns):
+    driver = "KML" if aoi_path.lower().endswith(".kml") else None
+    with fiona.open(aoi_path, driver=driver) as src:
+        crs = src.crs.to_wkt() if src.crs else "EPSG:4326"
+        names, geometries = [], []
+        for i, feat in enumerate(src):
+            props = dict(feat["properties"] or {})
+            names.append(props.get("Name") or props.get("name") or props.get("id") or str(i))
+            geometries.append(feat["geometry"])
+    return tuple(names), tuple(geometries), crs
+
+
+@lru_cache(maxsize=64)
+def _project_features(aoi_path, mtime_ns, dst_crs):
+    _, geometries, crs = _load_features(aoi_path, mtime_ns)
+    return tuple(transform_geom(crs, dst_crs, g) for g in geometries)
+
+
+def read_features(aoi_path):
+    """
+    Полигоны AOI (KML, GeoJSON, GeoPackage): (имена, геометрии, CRS).
+    Файл разбирается один раз, пока не изменится.
+    """
+    aoi_path = str(aoi_path)
+    return _load_features(aoi_path, os.stat(aoi_path).st_mtime_ns)
+
+
+def aoi_geometries(aoi_path, crs):
+    """Геометрии AOI в CRS растра; перепроецирование кэшируется по CRS."""
+    aoi_path = str(aoi_path)
+    return _project_features(aoi_path, os.stat(aoi_path).st_mtime_ns, crs.to_wkt())
+
+
+def aoi_window(src, kml_path):
+    """Окно растра, покрывающее охват AOI (без маски по контуру)."""
+    geometries = aoi_geometries(kml_path, src.crs)
+    return geometry_window(src, geometries)
+
+
+def write_cog(output_path, data, meta, compress="DEFLATE", blocksize=512):
+    """
+    Сохраняет массив как Cloud-Optimized GeoTIFF: тайлы, сжатие
+    и внутренние обзоры, сжатие идёт во всех ядрах.
+    """
+    profile = dict(meta, driver="GTiff", tiled=True, blockxsize=blocksize, blockysize=blocksize)
+    with MemoryFile() as mem:
+        with mem.open(**profile) as tmp:
+            tmp.write(data)
+        with mem.open() as tmp:
+            copy(
+                tmp,
+                output_path,
+                driver="COG",
+                compress=compress,
+                predictor="YES" if compress in ("DEFLATE", "ZSTD", "LZW") else "NO",
+                blocksize=blocksize,
+                overviews="AUTO",
+                num_threads="ALL_CPUS",
+                bigtiff="IF_SAFER",
+            )
+    return output_path
+
+
+def write_vrt(output_path, src, window):
+    """
+    Пишет VRT, ссылающийся на окно исходного растра: пиксели не копируются.
+    Маска по контуру AOI не применяется — обрезка только по охвату.
+    """
+    window = window.round_offsets().round_lengths()
+    transform = src.window_transform(window)
+    root = ET.Element("VRTDataset", rasterXSize=str(window.width), rasterYSize=str(window.height))
+    if src.crs:
+        ET.SubElement(root, "SRS").text = src.crs.to_wkt()
+    ET.SubElement(root, "GeoTransform").text = ", ".join(repr(v) for v in transform.to_gdal())
+    source_name = os.path.abspath(src.name)
+    for band, dtype in enumerate(src.dtypes, start=1):
+        vrt_band = ET.SubElement(
+            root, "VRTRasterBand", dataType=_gdal_dtype_name(dtype), band=str(band)
+        )
+        if src.nodata is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(src.nodata)
+        source = ET.SubElement(vrt_band, "SimpleSource")
+        ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = source_name
+        ET.SubElement(source, "SourceBand").text = str(band)
+        ET.SubElement(source, "SrcRect", xOff=str(window.col_off), yOff=str(window.row_off),
+                      xSize=str(window.width), ySize=str(window.height))
+        ET.SubElement(source, "DstRect", xOff="0", yOff="0",
+                      xSize=str(window.width), ySize=str(window.height))
+    ET.ElementTree(root).write(output_path, encoding="utf-8")
+    return output_path
+
+
+def _gdal_dtype_name(dtype):
+    return typename_fwd[dtype_rev[dtype]]
+
+
+def aoi_wkt(aoi, buffer_deg=AOI_BUFFER_DEG):
+    """
+    Охват AOI в WGS84 как WKT-полигон (для оператора Subset в SNAP).
+    ``aoi`` — путь к KML/GeoJSON/GeoPackage или готовая WKT-строка.
+    """
+    text = str(aoi).lstrip().upper()
+    if text.startswith(("POLYGON", "MULTIPOLYGON")):
+        return str(aoi)
+    geoms = aoi_geometries(aoi, CRS.from_epsg(4326))
+    bounds = unary_union([shape(g) for g in geoms]).bounds
+    return box(*bounds).buffer(buffer_deg, join_style=2).wkt
+
+
+def clip_image(image_path, kml_path, output_path, fmt="gtiff"):
+    """
+    Обрезает растр по AOI. ``fmt``: "gtiff" — обычный GeoTIFF,
+    "cog" — Cloud-Optimized GeoTIFF, "vrt" — виртуальный растр
+    поверх исходного файла без копирования пикселей.
+    """
     with rasterio.open(image_path) as src:
+        if fmt == "vrt":
+            return write_vrt(output_path, src, aoi_window(src, kml_path))
+        geometries = aoi_geometries(kml_path, src.crs)
+        # crop=True: читается только окно под охватом AOI
         out_image, out_transform = mask(src, geometries, crop=True)
         out_meta = src.meta.copy()
     out_meta.update({
@@ -15,14 +158,168 @@ def clip_image(image_path, kml_path, output_path):
         "width": out_image.shape[2],
         "transform": out_transform
     })
+    if fmt == "cog":
+        return write_cog(output_path, out_image, out_meta)
     with rasterio.open(output_path, "w", **out_meta) as dest:
         dest.write(out_image)
+    return output_path
+
+
+def clip_batch(image_paths, kml_path, out_dir, workers=4, suffix="_cropped", fmt="gtiff"):
+    """
+    Обрезает много растров по одному AOI в пуле потоков. AOI
+    разбирается один раз и перепроецируется один раз на каждую CRS.
+    Возвращает пути результатов в порядке ``image_paths``.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    read_features(kml_path)
+
+    def job(image_path):
+        ext = "vrt" if fmt == "vrt" else "tif"
+        out_path = out_dir / f"{Path(image_path).stem}{suffix}.{ext}"
+        return clip_image(image_path, kml_path, out_path, fmt)
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(job, image_paths))
+
+
+def _aligned_window(window, block, width, height):
+    bh, bw = block
+    r0 = int(window.row_off) // bh * bh
+    c0 = int(window.col_off) // bw * bw
+    r1 = min(-(-(int(window.row_off) + int(window.height)) // bh) * bh, height)
+    c1 = min(-(-(int(window.col_off) + int(window.width)) // bw) * bw, width)
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def group_by_blocks(windows, block, width, height, max_pixels=GROUP_MAX_PIXELS):
+    """
+    Группирует окна признаков, задевающие общие блоки растра.
+    Пересечения ищутся через STRtree по выровненным на блоки окнам,
+    группы собираются union-find. Охват группы ограничен ``max_pixels``:
+    иначе сплошной слой соседних участков слился бы в одну группу на всю
+    сцену (одно огромное чтение, без параллелизма, с блоками, которых
+    не касается ни один участок). Соседи, не влезающие в группу, уходят
+    в другую, их общие блоки читаются дважды. Возвращает
+    [(окно группы, [индексы])].
+    """
+    idx = [i for i, w in enumerate(windows) if w is not None]
+    aligned = {i: _aligned_window(windows[i], block, width, height) for i in idx}
+    # сжатие на полпикселя: соседние блоки касаются, но не пересекаются
+    boxes = [box(aligned[i].col_off + 0.5, aligned[i].row_off + 0.5,
+                 aligned[i].col_off + aligned[i].width - 0.5,
+                 aligned[i].row_off + aligned[i].height - 0.5) for i in idx]
+    tree = STRtree(boxes)
+
+    parent = list(range(len(idx)))
+    # охват группы (r0, c0, r1, c1) у корня
+    extent = [
+        (aligned[i].row_off, aligned[i].col_off,
+         aligned[i].row_off + aligned[i].height, aligned[i].col_off + aligned[i].width)
+        for i in idx
+    ]
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    # обход сверху вниз, слева направо: группы растут компактными кусками
+    order = sorted(range(len(idx)), key=lambda k: (aligned[idx[k]].row_off, aligned[idx[k]].col_off))
+    for k in order:
+        for j in sorted(int(j) for j in tree.query(boxes[k], predicate="intersects")):
+            a, b = find(k), find(j)
+            if a == b:
+                continue
+            ea, eb = extent[a], extent[b]
+            merged = (min(ea[0], eb[0]), min(ea[1], eb[1]), max(ea[2], eb[2]), max(ea[3], eb[3]))
+            if (merged[2] - merged[0]) * (merged[3] - merged[1]) > max_pixels:
+                continue
+            parent[b] = a
+            extent[a] = merged
+
+    groups = {}
+    for k, i in enumerate(idx):
+        groups.setdefault(find(k), []).append(i)
+
+    result = []
+    for root, members in groups.items():
+        r0, c0, r1, c1 = extent[root]
+        result.append((Window(c0, r0, c1 - c0, r1 - r0), members))
+    return result
+
+
+def clip_features(image_path, kml_path, out_dir, workers=4, fmt="gtiff"):
+    """
+    Вырезает отдельный чип на каждый полигон AOI. Полигоны, попадающие
+    в одни и те же блоки растра, объединяются в группу, окно группы
+    читается один раз, чипы вырезаются из него в памяти. Группы
+    обрабатываются параллельно. Возвращает пути чипов в порядке
+    полигонов (None, если полигон не пересекает растр).
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    names = read_features(kml_path)[0]
+    ext = "vrt" if fmt == "vrt" else "tif"
+    out_paths = [
+        out_dir / f"{i:05d}_{re.sub(r'[^0-9A-Za-z_.-]+', '_', name)}.{ext}"
+        for i, name in enumerate(names)
+    ]
+
+    with rasterio.open(image_path) as src:
+        geometries = aoi_geometries(kml_path, src.crs)
+        windows = []
+        for g in geometries:
+            try:
+                windows.append(geometry_window(src, [g]).round_offsets().round_lengths())
+            except WindowError:
+                windows.append(None)
+
+        if fmt == "vrt":
+            return [
+                write_vrt(p, src, w) if w is not None else None
+                for p, w in zip(out_paths, windows)
+            ]
+
+        block = src.block_shapes[0] if src.is_tiled else (512, 512)
+        groups = group_by_blocks(windows, block, src.width, src.height)
+        meta = src.meta.copy()
+        nodata = src.nodata if src.nodata is not None else 0
+
+    def job(group):
+        group_win, members = group
+        with rasterio.open(image_path) as src:
+            data = src.read(window=group_win)
+            for i in members:
+                win = windows[i]
+                r = int(win.row_off - group_win.row_off)
+                c = int(win.col_off - group_win.col_off)
+                h, w = int(win.height), int(win.width)
+                transform = src.window_transform(win)
+                chip = data[:, r:r + h, c:c + w].copy()
+                chip[:, geometry_mask([geometries[i]], (h, w), transform)] = nodata
+                chip_meta = dict(meta, driver="GTiff", height=h, width=w,
+                                 transform=transform, nodata=nodata)
+                if fmt == "cog":
+                    write_cog(out_paths[i], chip, chip_meta)
+                else:
+                    with rasterio.open(out_paths[i], "w", **chip_meta) as dest:
+                        dest.write(chip)
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(job, groups))
+
+    return [p if w is not None else None for p, w in zip(out_paths, windows)]
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Использование: python clip.py <input_image> <input_kml> <output_image>")
+    if len(sys.argv) not in (4, 5) or sys.argv[4:] not in ([], ["gtiff"], ["cog"], ["vrt"]):
+        print("Использование: python clip.py <input_image> <input_kml> <output_image> [gtiff|cog|vrt]")
         sys.exit(1)
     image_path = sys.argv[1]
     kml_path = sys.argv[2]
     output_path = sys.argv[3]
-    clip_image(image_path, kml_path, output_path)
\ No newline at end of file
+    fmt = sys.argv[4] if len(sys.argv) == 5 else "gtiff"
+    clip_image(image_path, kml_path, output_path, fmt)
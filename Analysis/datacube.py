@@ -0,0 +1,185 @@
+import datetime
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine, rowcol
+from rasterio.windows import Window
+
+from indicies import INDEX_RANGES, IndexEngine, read_window
+
+
+class IndexCube:
+    """
+    Многодатный куб индексов на диске для одного AOI.
+
+    Растр делится на тайлы ``tile × tile``; для каждой пары (индекс, тайл)
+    заводится файл ``<индекс>/<строка>_<столбец>.f32`` с массивом
+    float32 формы (даты, h, w). Новая дата дописывается в конец каждого
+    файла, поэтому добавление не трогает старые данные, а временной ряд
+    пикселя и срез за дату читаются через memmap без загрузки сцен.
+    Метаданные (сетка, CRS, список дат) лежат в ``cube.json``. Даты можно
+    дописывать не по порядку: ряды и список дат отдаются по возрастанию.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        with open(self.root / "cube.json") as f:
+            self.meta = json.load(f)
+        self.transform = Affine(*self.meta["transform"])
+
+    @classmethod
+    def create(cls, root, tif_path, names=None, tile=256):
+        """Создаёт пустой куб с сеткой и CRS растра ``tif_path``."""
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        names = list(names or INDEX_RANGES)
+        with rasterio.open(tif_path) as src:
+            meta = {
+                "crs": src.crs.to_wkt(),
+                "transform": list(src.transform)[:6],
+                "height": src.height,
+                "width": src.width,
+                "tile": tile,
+                "indices": names,
+                "dates": [],
+            }
+        for name in names:
+            (root / name).mkdir(exist_ok=True)
+        _write_json(root / "cube.json", meta)
+        return cls(root)
+
+    @classmethod
+    def open_or_create(cls, root, tif_path, names=None, tile=256):
+        if (Path(root) / "cube.json").exists():
+            return cls(root)
+        return cls.create(root, tif_path, names, tile)
+
+    @property
+    def dates(self):
+        """Даты куба по возрастанию (дописываться они могут в любом порядке)."""
+        return sorted(self.meta["dates"])
+
+    def _date_order(self):
+        # номера слоёв в файлах тайлов в порядке возрастания дат
+        return np.argsort(np.array(self.meta["dates"]), kind="stable")
+
+    @property
+    def indices(self):
+        return list(self.meta["indices"])
+
+    def tiles(self):
+        t = self.meta["tile"]
+        h, w = self.meta["height"], self.meta["width"]
+        for row in range(0, h, t):
+            for col in range(0, w, t):
+                yield Window(col, row, min(t, w - col), min(t, h - row))
+
+    def _chunk_path(self, name, window):
+        t = self.meta["tile"]
+        return self.root / name / f"{window.row_off // t}_{window.col_off // t}.f32"
+
+    def _chunk(self, name, window):
+        n = len(self.meta["dates"])
+        shape = (n, int(window.height), int(window.width))
+        return np.memmap(self._chunk_path(name, window), dtype=np.float32, mode="r", shape=shape)
+
+    def _tile_of(self, row, col):
+        t = self.meta["tile"]
+        r0, c0 = row - row % t, col - col % t
+        return Window(c0, r0,
+                      min(t, self.meta["width"] - c0),
+                      min(t, self.meta["height"] - r0))
+
+    def append(self, date, tif_path, formulas=None):
+        """
+        Считает индексы сцены за ``date`` по тайлам и дописывает их в куб.
+        Сцена должна лежать на той же сетке, что и куб.
+        """
+        try:
+            # ISO-строки сортируются так же, как даты
+            date = datetime.date.fromisoformat(str(date)).isoformat()
+        except ValueError:
+            raise ValueError(f"Дата {date!r} не в формате YYYY-MM-DD") from None
+        if date in self.meta["dates"]:
+            raise ValueError(f"Дата {date} уже есть в кубе")
+
+        engine = IndexEngine(self.indices, formulas)
+        n = len(self.meta["dates"])
+        with rasterio.open(tif_path) as src:
+            if (src.height, src.width) != (self.meta["height"], self.meta["width"]) \
+                    or not src.transform.almost_equals(self.transform) \
+                    or src.crs != CRS.from_wkt(self.meta["crs"]):
+                raise ValueError(f"{tif_path}: сетка растра не совпадает с кубом")
+
+            for win in self.tiles():
+                out = engine.compute(
+                    read_window(src, win, engine.bands), bands=engine.bands, nodata=src.nodata
+                )
+                size = int(win.height) * int(win.width) * 4
+                for name in self.indices:
+                    with open(self._chunk_path(name, win), "ab") as f:
+                        # хвост от прерванной дозаписи отбрасывается
+                        f.truncate(n * size)
+                        f.write(out[name].tobytes())
+
+        self.meta["dates"].append(date)
+        _write_json(self.root / "cube.json", self.meta)
+
+    def pixel_series(self, name, row, col):
+        """Временной ряд индекса в пикселе по возрастанию дат: (даты, значения)."""
+        if name not in self.meta["indices"]:
+            raise KeyError(f"Индекса {name} нет в кубе")
+        if not self.meta["dates"]:
+            raise ValueError("Куб пуст: не добавлено ни одной даты")
+        if not (0 <= row < self.meta["height"] and 0 <= col < self.meta["width"]):
+            raise IndexError(
+                f"Пиксель ({row}, {col}) вне растра куба "
+                f"{self.meta['height']}×{self.meta['width']}"
+            )
+        win = self._tile_of(row, col)
+        values = self._chunk(name, win)[:, row - win.row_off, col - win.col_off]
+        return self.dates, np.array(values[self._date_order()])
+
+    def point_series(self, name, x, y):
+        """Временной ряд индекса в точке с координатами в CRS куба."""
+        row, col = rowcol(self.transform, x, y)
+        return self.pixel_series(name, row, col)
+
+    def date_slice(self, name, date, window=None):
+        """Растр индекса за дату; ``window`` ограничивает область чтения."""
+        i = self.meta["dates"].index(datetime.date.fromisoformat(str(date)).isoformat())
+        window = window or Window(0, 0, self.meta["width"], self.meta["height"])
+        r0, c0 = int(window.row_off), int(window.col_off)
+        r1, c1 = r0 + int(window.height), c0 + int(window.width)
+        out = np.empty((r1 - r0, c1 - c0), dtype=np.float32)
+        for win in self.tiles():
+            tr0, tc0 = int(win.row_off), int(win.col_off)
+            tr1, tc1 = tr0 + int(win.height), tc0 + int(win.width)
+            if tr1 <= r0 or tr0 >= r1 or tc1 <= c0 or tc0 >= c1:
+                continue
+            ar0, ar1 = max(r0, tr0), min(r1, tr1)
+            ac0, ac1 = max(c0, tc0), min(c1, tc1)
+            out[ar0 - r0:ar1 - r0, ac0 - c0:ac1 - c0] = \
+                self._chunk(name, win)[i, ar0 - tr0:ar1 - tr0, ac0 - tc0:ac1 - tc0]
+        return out
+
+
+def _write_json(path, data):
+    tmp = Path(f"{path}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Использование: python datacube.py <папка_куба> <дата YYYY-MM-DD> <input_image>")
+        sys.exit(1)
+    cube = IndexCube.open_or_create(sys.argv[1], sys.argv[3])
+    cube.append(sys.argv[2], sys.argv[3])
+    print(f"Дата {sys.argv[2]} добавлена, в кубе {len(cube.dates)} дат")
@@ -0,0 +1,128 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from matplotlib import colormaps, font_manager
+
+# карты рисуются параллельно, но не больше стольких сразу: каждая держит
+# свои временные массивы размером с растр
+RENDER_WORKERS = 4
+
+_LUTS = {}
+_FONTS = {}
+
+
+def colormap_lut(cmap="viridis"):
+    """
+    Таблица RGB на 257 строк: 256 цветов палитры и белый для NaN.
+    Считается один раз на палитру.
+    """
+    if cmap not in _LUTS:
+        lut = np.empty((257, 3), dtype=np.uint8)
+        lut[:256] = (colormaps[cmap](np.linspace(0, 1, 256))[:, :3] * 255).round()
+        lut[256] = 255
+        _LUTS[cmap] = lut
+    return _LUTS[cmap]
+
+
+def _font(size):
+    if size not in _FONTS:
+        # DejaVu Sans идёт вместе с matplotlib и содержит кириллицу
+        _FONTS[size] = ImageFont.truetype(font_manager.findfont("DejaVu Sans"), size)
+    return _FONTS[size]
+
+
+def colorize(values, vmin, vmax, cmap="viridis"):
+    """Переводит двумерный массив значений в RGB через таблицу палитры."""
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    scaled = np.subtract(values, vmin, dtype=np.float32)
+    scaled *= scale
+    np.clip(scaled, 0, 255, out=scaled)
+    with np.errstate(invalid="ignore"):
+        codes = scaled.astype(np.uint16)
+    codes[np.isnan(values)] = 256
+    return colormap_lut(cmap)[codes]
+
+
+def render_heatmap(values, title, label, vmin=None, vmax=None,
+                   cmap="viridis", fmt="png", preview=None):
+    """
+    Рисует тепловую карту с заголовком и цветовой шкалой и возвращает
+    байты PNG или WebP. ``preview`` — максимальная сторона карты
+    в пикселях: растр прореживается до раскраски.
+    """
+    if preview:
+        step = max(1, -(-max(values.shape) // preview))
+        values = values[::step, ::step]
+    if vmin is None:
+        vmin = float(np.nanmin(values))
+    if vmax is None:
+        vmax = float(np.nanmax(values))
+
+    img = Image.fromarray(colorize(values, vmin, vmax, cmap))
+    w, h = img.size
+
+    fs = max(12, min(48, max(w, h) // 40))
+    font = _font(fs)
+    pad = fs
+    bar_w = max(12, fs)
+    ticks = np.linspace(vmin, vmax, 5)
+    ticks[np.abs(ticks) < (vmax - vmin) * 1e-6] = 0
+    tick_labels = [f"{t:.3g}" for t in ticks]
+    tick_w = max(font.getbbox(t)[2] for t in tick_labels)
+    title_h = font.getbbox(title)[3]
+    label_h = font.getbbox(label)[3]
+
+    canvas = Image.new(
+        "RGB",
+        (pad + w + pad + bar_w + fs // 2 + tick_w + pad + label_h + pad,
+         pad + title_h + pad + h + pad),
+        "white",
+    )
+    draw = ImageDraw.Draw(canvas)
+    draw.text(((pad + w) // 2, pad), title, fill="black", font=font, anchor="mt")
+
+    top = pad + title_h + pad
+    canvas.paste(img, (pad, top))
+
+    bar_x = pad + w + pad
+    gradient = colormap_lut(cmap)[np.linspace(255, 0, h).astype(np.uint16)]
+    canvas.paste(Image.fromarray(np.repeat(gradient[:, None], bar_w, axis=1)), (bar_x, top))
+    draw.rectangle((bar_x, top, bar_x + bar_w - 1, top + h - 1), outline="black")
+
+    for t, text in zip(ticks, tick_labels):
+        y = top + round((vmax - t) / (vmax - vmin) * (h - 1)) if vmax > vmin else top + h // 2
+        draw.line((bar_x + bar_w, y, bar_x + bar_w + fs // 4, y), fill="black")
+        draw.text((bar_x + bar_w + fs // 2, y), text, fill="black", font=font, anchor="lm")
+
+    label_img = Image.new("RGB", (font.getbbox(label)[2], label_h), "white")
+    ImageDraw.Draw(label_img).text((0, 0), label, fill="black", font=font)
+    label_img = label_img.rotate(90, expand=True)
+    canvas.paste(label_img, (bar_x + bar_w + fs // 2 + tick_w + pad, top + (h - label_img.height) // 2))
+
+    buf = io.BytesIO()
+    if fmt == "webp":
+        canvas.save(buf, format="WEBP", lossless=True, method=0)
+    else:
+        canvas.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def render_all(indices, limits=None, fmt="png", preview=None, workers=RENDER_WORKERS, cmap="viridis"):
+    """
+    Рисует все индексы параллельно. ``indices`` — {имя: массив},
+    ``limits`` — {имя: (vmin, vmax)}; без них шкала берётся по данным.
+    Возвращает {имя: байты изображения}.
+    """
+    limits = limits or {}
+
+    def job(name):
+        vmin, vmax = limits.get(name, (None, None))
+        return render_heatmap(
+            indices[name], f"Тепловая карта {name}", f"{name} value",
+            vmin, vmax, cmap=cmap, fmt=fmt, preview=preview,
+        )
+
+    with ThreadPoolExecutor(max(1, min(workers or RENDER_WORKERS, len(indices)))) as pool:
+        return dict(zip(indices, pool.map(job, indices)))
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from indicies import EPS, INDEX_FORMULAS, IndexEngine
+
+# меняется при изменении способа расчёта (маски nodata, типов и т.п.)
+CACHE_VERSION = 1
+
+# сколько отпечатков содержимого помнить между запусками
+MAX_FINGERPRINTS = 1024
+
+
+class IndexCache:
+    """
+    Дисковый кэш растров индексов.
+
+    Ключ — отпечаток входного файла, имя индекса и версия формулы
+    (хэш её текста вместе с EPS и CACHE_VERSION). Отпечаток по умолчанию
+    строится по пути, mtime и размеру; с ``by_content=True`` — по
+    содержимому файла (нужно, когда один и тот же снимок каждый раз
+    приходит под новым путём, как в Streamlit). Хэш содержимого
+    запоминается в ``fingerprints.json`` по (путь, mtime, размер, inode),
+    так что повторный запуск по тому же файлу его не пересчитывает;
+    если отпечаток уже известен вызывающему (например, хэш загруженных
+    байтов), его можно передать через ``remember``. Значения хранятся как
+    .npy и отдаются через memmap. Объём ограничен ``max_bytes``, при
+    превышении удаляются давно не читанные записи (LRU по mtime файлов).
+    """
+
+    def __init__(self, root, max_bytes=2 << 30, by_content=False):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.by_content = by_content
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fingerprints = None
+
+    @staticmethod
+    def _ident(tif_path):
+        st = os.stat(tif_path)
+        return repr((os.path.abspath(tif_path), st.st_mtime_ns, st.st_size, st.st_ino))
+
+    def _memo(self):
+        if self._fingerprints is None:
+            try:
+                with open(self.root / "fingerprints.json") as f:
+                    self._fingerprints = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._fingerprints = {}
+        return self._fingerprints
+
+    def remember(self, tif_path, fingerprint):
+        """Запоминает уже известный отпечаток содержимого ``tif_path``."""
+        memo = self._memo()
+        memo[self._ident(tif_path)] = fingerprint
+        for ident in list(memo)[:-MAX_FINGERPRINTS]:
+            del memo[ident]
+        path = self.root / "fingerprints.json"
+        tmp = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(memo, f)
+        os.replace(tmp, path)
+
+    def fingerprint(self, tif_path):
+        ident = self._ident(tif_path)
+        if not self.by_content:
+            return hashlib.blake2b(ident.encode(), digest_size=16).hexdigest()
+        memo = self._memo()
+        if ident not in memo:
+            h = hashlib.blake2b(digest_size=16)
+            with open(tif_path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            self.remember(tif_path, h.hexdigest())
+        return memo[ident]
+
+    @staticmethod
+    def formula_version(formula):
+        text = f"{CACHE_VERSION}|{EPS!r}|{formula}"
+        return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+    def _path(self, fingerprint, name, formula):
+        return self.root / f"{fingerprint}_{name}_{self.formula_version(formula)}.npy"
+
+    def get(self, tif_path, name, formula=None):
+        path = self._path(self.fingerprint(tif_path), name, formula or INDEX_FORMULAS[name])
+        try:
+            values = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass  # вытеснен другим процессом; открытый memmap остаётся рабочим
+        self.hits += 1
+        return values
+
+    def put(self, tif_path, name, values, formula=None):
+        path = self._path(self.fingerprint(tif_path), name, formula or INDEX_FORMULAS[name])
+        tmp = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp, path)
+        self.evict()
+        return path
+
+    def compute(self, tif_path, names, formulas=None):
+        """
+        Индексы ``names`` для снимка: из кэша, а отсутствующие считаются
+        одним проходом движка и сохраняются.
+        """
+        table = dict(INDEX_FORMULAS)
+        table.update(formulas or {})
+
+        result, missing = {}, []
+        for name in names:
+            values = self.get(tif_path, name, table.get(name))
+            if values is None:
+                missing.append(name)
+            else:
+                result[name] = values
+
+        if missing:
+            engine = IndexEngine(missing, formulas)
+            with rasterio.open(tif_path) as src:
+                B = src.read([b + 1 for b in engine.bands])
+                nodata = src.nodata
+            computed = engine.compute(B, bands=engine.bands, nodata=nodata)
+            for name in missing:
+                self.put(tif_path, name, computed[name], table[name])
+                result[name] = computed[name]
+
+        return {name: result[name] for name in names}
+
+    def entries(self):
+        """
+        Записи кэша [(путь, размер)] от давно не читанных к свежим. Файлы,
+        которые другой процесс удалил между glob и stat, пропускаются.
+        """
+        found = []
+        for path in self.root.glob("*.npy"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            found.append((st.st_mtime, path, st.st_size))
+        found.sort(key=lambda e: e[0])
+        return [(path, size) for _, path, size in found]
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size in entries)
+        for path, size in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size in entries),
+            "max_bytes": self.max_bytes,
+        }
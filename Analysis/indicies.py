@@ -1,26 +1,35 @@
-import sys
+import argparse
+import ast
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import numpy as np
 import rasterio
-import matplotlib.pyplot as plt
+from rasterio.windows import Window
 
-def get_index(name: str, B: np.ndarray) -> np.ndarray:
-    eps = 1e-8
-    if name == "NDWI":   return (B[2] - B[7]) / (B[2] + B[7] + eps)
-    if name == "NDMI":   return (B[7] - B[11]) / (B[7] + B[11] + eps)
-    if name == "NDVI":   return (B[7] - B[3]) / (B[7] + B[3] + eps)
-    if name == "SR":     return B[7] / (B[3] + eps)
-    if name == "REP":
-        num = ((B[6] + B[3]) / 2) - B[4]
-        den = (B[5] - B[4]) + eps
-        return 700 + 40 * (num / den)
-    if name == "EVI":    return 2.5 * (B[7] - B[3]) / (B[7] + 6 * B[3] - 7.5 * B[1] + 1 + eps)
-    if name == "EVI2":   return 2.5 * (B[7] - B[3]) / (B[7] + B[3] + 1 + eps)
-    if name == "ARVI":   return (B[7] - (2 * B[3] - B[1])) / (B[7] + (2 * B[3] - B[1]) + eps)
-    if name == "SAVI":   return 1.5 * (B[7] - B[3]) / (B[7] + B[3] + 0.5 + eps)
-    if name == "GOSAVI": return (B[7] - B[2]) / (B[7] + B[2] + 0.16 + eps)
-    if name == "GARI":   return (B[7] - (B[2] - (B[1] - B[3]))) / (B[7] + (B[2] - (B[1] - B[3])) + eps)
-    if name == "VARI":   return (B[2] - B[3]) / (B[2] + B[3] - B[1] + eps)
-    raise ValueError(f"Unsupported index {name}")
+from heatmap import render_all
+
+EPS = 1e-8
+
+# максимальная сторона тепловой карты по умолчанию, пикселей
+PREVIEW_PX = 2048
+
+# Порядок каналов Sentinel-2 L1C в 13-канальном GeoTIFF (B[0] … B[12])
+BAND_NAMES = ("B1", "B2", "B3", "B4", "B5", "B6", "B7",
+              "B8", "B8A", "B9", "B10", "B11", "B12")
+
+INDEX_FORMULAS = {
+    "NDWI":   "(B3 - B8) / (B3 + B8 + eps)",
+    "NDMI":   "(B8 - B11) / (B8 + B11 + eps)",
+    "NDVI":   "(B8 - B4) / (B8 + B4 + eps)",
+    "SR":     "B8 / (B4 + eps)",
+    "REP":    "700 + 40 * ((((B7 + B4) / 2) - B5) / ((B6 - B5) + eps))",
+    "EVI":    "2.5 * (B8 - B4) / (B8 + 6 * B4 - 7.5 * B2 + 1 + eps)",
+    "EVI2":   "2.5 * (B8 - B4) / (B8 + B4 + 1 + eps)",
+    "ARVI":   "(B8 - (2 * B4 - B2)) / (B8 + (2 * B4 - B2) + eps)",
+    "SAVI":   "1.5 * (B8 - B4) / (B8 + B4 + 0.5 + eps)",
+    "GOSAVI": "(B8 - B3) / (B8 + B3 + 0.16 + eps)",
+    "GARI":   "(B8 - (B3 - (B2 - B4))) / (B8 + (B3 - (B2 - B4)) + eps)",
+    "VARI":   "(B3 - B4) / (B3 + B4 - B2 + eps)",
+}
 
 INDEX_RANGES = {
     "NDWI":   (-1,  1),
@@ -37,42 +46,438 @@ INDEX_RANGES = {
     "VARI":  (-2,  2),
 }
 
-def main():
-    if len(sys.argv) != 2:
-        print("Использование: python compute_indices.py <путь_к_файлу.tif>")
-        sys.exit(1)
+_BINOPS = {
+    ast.Add:  (np.add,      True),
+    ast.Sub:  (np.subtract, False),
+    ast.Mult: (np.multiply, True),
+    ast.Div:  (np.divide,   False),
+    ast.Pow:  (np.power,    False),
+}
 
-    tif_path = sys.argv[1]
 
-    with rasterio.open(tif_path) as src:
-        B = src.read().astype('float32')
-        nodata = src.nodata
-        if nodata is not None:
-            B = np.where(B == nodata, np.nan, B)
-
-    for name, (low, high) in INDEX_RANGES.items():
-        try:
-            idx = get_index(name, B)
-        except Exception as e:
-            print(f"{name}: ошибка при вычислении → {e}")
-            continue
-
-        idx_min = np.nanmin(idx)
-        idx_max = np.nanmax(idx)
-
-        if idx_min >= low and idx_max <= high:
-            print(f"{name}: OK ({idx_min:.3f}…{idx_max:.3f} ∈ [{low},{high}])")
+def _node_args(node):
+    if node[0] == "op":
+        return node[2:]
+    if node[0] == "neg":
+        return node[1:]
+    return ()
+
+
+class IndexEngine:
+    """
+    Вычисляет набор индексов за один проход по растру.
+
+    Формулы всех запрошенных индексов разбираются в общий граф, одинаковые
+    подвыражения (``B8 + B4``, ``2 * B4 - B2`` …) считаются один раз.
+    Растр обходится полосами строк по ``chunk_pixels`` пикселей, временные
+    буферы переиспользуются между узлами графа, результат пишется сразу
+    в выходные массивы.
+    """
+
+    def __init__(self, names, formulas=None, chunk_pixels=1 << 16):
+        table = dict(INDEX_FORMULAS)
+        if formulas:
+            table.update(formulas)
+
+        self.names = list(names)
+        self.chunk_pixels = chunk_pixels
+        self.nodes = []          # ("band", i) | ("const", v) | ("op", ufunc, a, b) | ("neg", a)
+        self._keys = {}
+        self.roots = {}
+        for name in self.names:
+            if name not in table:
+                raise ValueError(f"Unsupported index {name}")
+            tree = ast.parse(table[name], mode="eval")
+            self.roots[name] = self._build(tree.body, name)
+
+        # последний узел, который читает каждый узел: после него буфер свободен
+        self._last_use = {}
+        for i, node in enumerate(self.nodes):
+            for arg in _node_args(node):
+                self._last_use[arg] = i
+
+        self.bands = tuple(sorted(n[1] for n in self.nodes if n[0] == "band"))
+
+        # каналы, от которых зависит каждый индекс: по ним строится маска nodata
+        deps = []
+        for node in self.nodes:
+            if node[0] == "band":
+                deps.append(frozenset((node[1],)))
+            else:
+                deps.append(frozenset().union(*(deps[a] for a in _node_args(node))))
+        self.index_bands = {name: tuple(sorted(deps[root])) for name, root in self.roots.items()}
+
+    def _add(self, key, node):
+        if key not in self._keys:
+            self._keys[key] = len(self.nodes)
+            self.nodes.append(node)
+        return self._keys[key]
+
+    def _build(self, expr, name):
+        if isinstance(expr, ast.Name):
+            if expr.id == "eps":
+                return self._add(("const", EPS), ("const", EPS))
+            if expr.id not in BAND_NAMES:
+                raise ValueError(f"{name}: неизвестный канал {expr.id}")
+            i = BAND_NAMES.index(expr.id)
+            return self._add(("band", i), ("band", i))
+
+        if isinstance(expr, ast.Constant) and isinstance(expr.value, (int, float)):
+            v = float(expr.value)
+            return self._add(("const", v), ("const", v))
+
+        if isinstance(expr, ast.UnaryOp) and isinstance(expr.op, (ast.USub, ast.UAdd)):
+            a = self._build(expr.operand, name)
+            if isinstance(expr.op, ast.UAdd):
+                return a
+            if self.nodes[a][0] == "const":
+                v = -self.nodes[a][1]
+                return self._add(("const", v), ("const", v))
+            return self._add(("neg", a), ("neg", a))
+
+        if isinstance(expr, ast.BinOp) and type(expr.op) in _BINOPS:
+            ufunc, commutative = _BINOPS[type(expr.op)]
+            a = self._build(expr.left, name)
+            b = self._build(expr.right, name)
+            if self.nodes[a][0] == "const" and self.nodes[b][0] == "const":
+                v = float(ufunc(self.nodes[a][1], self.nodes[b][1]))
+                return self._add(("const", v), ("const", v))
+            if commutative and a > b:
+                a, b = b, a
+            return self._add((ufunc.__name__, a, b), ("op", ufunc, a, b))
+
+        raise ValueError(f"{name}: недопустимое выражение {ast.dump(expr)}")
+
+    def allocate(self, shape):
+        return {name: np.empty(shape, dtype=np.float32) for name in self.names}
+
+    def compute(self, B, out=None, bands=None, nodata=None):
+        """
+        B — массив (каналы, H, W) в исходном типе данных; вычисления идут
+        во float32. Возвращает словарь {индекс: массив (H, W)}.
+
+        ``bands`` — номера каналов (с нуля), лежащих в B по порядку, если
+        прочитаны не все 13 (обычно ``engine.bands``). Пиксели, где любой
+        нужный индексу канал равен ``nodata`` или замаскирован
+        (``np.ma.MaskedArray``), получают NaN; маска строится по кускам
+        и на весь куб не разворачивается.
+        """
+        h, w = B.shape[1:]
+        if out is None:
+            out = self.allocate((h, w))
+
+        if isinstance(B, np.ma.MaskedArray):
+            masks = np.ma.getmask(B)
+            B = B.data
         else:
-            print(f"{name}: ВНЕ ДИАПАЗОНА ({idx_min:.3f}…{idx_max:.3f} ∉ [{low},{high}])")
+            masks = np.ma.nomask
+        if masks is np.ma.nomask and (nodata is None or np.isnan(nodata)):
+            masks = None
+
+        pos = {b: i for i, b in enumerate(bands)} if bands is not None else None
+        rows = max(1, min(h, self.chunk_pixels // max(w, 1)))
+        pool = []
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for r0 in range(0, h, rows):
+                r1 = min(r0 + rows, h)
+                self._compute_rows(B, out, r0, r1, pool, pos)
+                if masks is not None:
+                    self._mask_rows(B, masks, nodata, out, r0, r1, pos)
+        return out
+
+    def _mask_rows(self, B, masks, nodata, out, r0, r1, pos):
+        band_masks = {}
+        index_masks = {}
+        for name, deps in self.index_bands.items():
+            if deps not in index_masks:
+                m = None
+                for b in deps:
+                    if b not in band_masks:
+                        k = pos[b] if pos is not None else b
+                        band_masks[b] = B[k, r0:r1] == nodata if masks is np.ma.nomask else masks[k, r0:r1]
+                    m = band_masks[b] if m is None else m | band_masks[b]
+                index_masks[deps] = m
+            if index_masks[deps] is not None:
+                np.copyto(out[name][r0:r1], np.nan, where=index_masks[deps])
+
+    def _compute_rows(self, B, out, r0, r1, pool, pos=None):
+        shape = (r1 - r0, B.shape[2])
+        pool[:] = [buf for buf in pool if buf.shape == shape]
+
+        targets = {}
+        direct = set()
+        for name, root in self.roots.items():
+            if root not in targets and self.nodes[root][0] in ("op", "neg"):
+                targets[root] = out[name][r0:r1]
+                direct.add(name)
+
+        values = {}
+        owned = set()
+        for i, node in enumerate(self.nodes):
+            kind = node[0]
+            if kind == "band":
+                values[i] = B[pos[node[1]] if pos is not None else node[1], r0:r1]
+                continue
+            if kind == "const":
+                values[i] = node[1]
+                continue
+
+            if i in targets:
+                buf = targets[i]
+            else:
+                buf = pool.pop() if pool else np.empty(shape, dtype=np.float32)
+                owned.add(i)
+
+            if kind == "neg":
+                np.negative(values[node[1]], out=buf, dtype=np.float32)
+            else:
+                node[1](values[node[2]], values[node[3]], out=buf, dtype=np.float32)
+            values[i] = buf
+
+            for a in set(_node_args(node)):
+                if self._last_use.get(a) == i and a in owned and a not in targets:
+                    pool.append(values.pop(a))
+                    owned.discard(a)
+
+        for name, root in self.roots.items():
+            if name not in direct:
+                out[name][r0:r1] = values[root]
+
+
+def get_index(name: str, B: np.ndarray) -> np.ndarray:
+    return IndexEngine([name]).compute(B)[name]
+
+
+class IndexStats:
+    """
+    Накопитель nanmin/nanmax и гистограммы индексов, заполняемый по окнам.
+    Гистограмма строится на диапазоне из INDEX_RANGES, значения вне его
+    считаются отдельно в ``below``/``above``.
+    """
+
+    def __init__(self, names, bins=256, ranges=None):
+        ranges = ranges or INDEX_RANGES
+        self.bins = bins
+        self.ranges = {name: ranges.get(name, (-1, 1)) for name in names}
+        self.min = {name: np.nan for name in names}
+        self.max = {name: np.nan for name in names}
+        self.hist = {name: np.zeros(bins, dtype=np.int64) for name in names}
+        self.below = dict.fromkeys(names, 0)
+        self.above = dict.fromkeys(names, 0)
+        self.count = dict.fromkeys(names, 0)
+
+    def update(self, name, values):
+        low, high = self.ranges[name]
+        self.min[name] = np.fmin(self.min[name], np.fmin.reduce(values, axis=None))
+        self.max[name] = np.fmax(self.max[name], np.fmax.reduce(values, axis=None))
+        with np.errstate(invalid="ignore"):
+            self.hist[name] += np.histogram(values, bins=self.bins, range=(low, high))[0]
+            self.below[name] += int(np.count_nonzero(values < low))
+            self.above[name] += int(np.count_nonzero(values > high))
+        self.count[name] += int(values.size - np.count_nonzero(np.isnan(values)))
+
+    def merge(self, other):
+        for name in self.min:
+            self.min[name] = np.fmin(self.min[name], other.min[name])
+            self.max[name] = np.fmax(self.max[name], other.max[name])
+            self.hist[name] += other.hist[name]
+            self.below[name] += other.below[name]
+            self.above[name] += other.above[name]
+            self.count[name] += other.count[name]
+        return self
+
+
+def iter_windows(src, tile=512):
+    """
+    Окна чтения: блоки самого GeoTIFF, если он тайловый, иначе полосы
+    по ``tile`` строк на всю ширину растра.
+    """
+    bh, bw = src.block_shapes[0]
+    if src.is_tiled and bh > 1 and bw > 1:
+        for _, win in src.block_windows(1):
+            yield win
+        return
+    for row in range(0, src.height, tile):
+        yield Window(0, row, src.width, min(tile, src.height - row))
+
+
+def read_window(src, window, bands):
+    """Читает только нужные каналы окна в исходном типе данных."""
+    return src.read([b + 1 for b in bands], window=window)
+
+
+_worker = {}
+
+
+def _init_worker(tif_path, names, formulas):
+    _worker["src"] = rasterio.open(tif_path)
+    _worker["engine"] = IndexEngine(names, formulas)
+
+
+def _compute_window(window):
+    # каждый процесс читает своё окно из файла сам: каналы не передаются
+    # между процессами, общий для всех только страничный кэш ОС
+    engine = _worker["engine"]
+    src = _worker["src"]
+    out = engine.compute(read_window(src, window, engine.bands), bands=engine.bands, nodata=src.nodata)
+    stats = IndexStats(engine.names)
+    for name, values in out.items():
+        stats.update(name, values)
+    return window, out, stats
+
+
+def stream_indices(tif_path, out_path, names=None, formulas=None, tile=512, workers=1):
+    """
+    Считает индексы по окнам, не загружая сцену целиком: каждое окно
+    читается, обсчитывается и сразу пишется в тайловый GeoTIFF
+    (по каналу на индекс). Возвращает IndexStats по всей сцене.
+
+    При ``workers > 1`` окна раздаются пулу процессов; в работе держится
+    не больше ``2 * workers`` окон, запись и статистика собираются
+    в основном процессе.
+    """
+    names = list(names or INDEX_RANGES)
+    stats = IndexStats(names)
+
+    with rasterio.open(tif_path) as src:
+        profile = src.profile.copy()
+        profile.update(
+            driver="GTiff",
+            count=len(names),
+            dtype="float32",
+            nodata=np.nan,
+            tiled=True,
+            blockxsize=tile,
+            blockysize=tile,
+            compress="deflate",
+            predictor=3,
+            interleave="band",
+            BIGTIFF="IF_SAFER",
+        )
+        profile.pop("photometric", None)
+        if workers > 1:
+            # сжатие тайлов в GDAL тоже идёт в несколько потоков
+            profile["num_threads"] = workers
+        windows = list(iter_windows(src, tile))
+
+        with rasterio.open(out_path, "w", **profile) as dst:
+            dst.descriptions = tuple(names)
+
+            if workers <= 1:
+                engine = IndexEngine(names, formulas)
+                out = None
+                for win in windows:
+                    B = read_window(src, win, engine.bands)
+                    shape = B.shape[1:]
+                    if out is None or out[names[0]].shape != shape:
+                        out = engine.allocate(shape)
+                    engine.compute(B, out=out, bands=engine.bands, nodata=src.nodata)
+                    for i, name in enumerate(names, start=1):
+                        dst.write(out[name], i, window=win)
+                        stats.update(name, out[name])
+                return stats
+
+            with ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(tif_path, names, formulas)
+            ) as pool:
+                pending = set()
+                queue = iter(windows)
+                while True:
+                    for win in queue:
+                        pending.add(pool.submit(_compute_window, win))
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        win, out, part = fut.result()
+                        for i, name in enumerate(names, start=1):
+                            dst.write(out[name], i, window=win)
+                        stats.merge(part)
+
+    return stats
+
+
+def check_range(name, idx_min, idx_max):
+    low, high = INDEX_RANGES[name]
+    if idx_min >= low and idx_max <= high:
+        print(f"{name}: OK ({idx_min:.3f}…{idx_max:.3f} ∈ [{low},{high}])")
+    else:
+        print(f"{name}: ВНЕ ДИАПАЗОНА ({idx_min:.3f}…{idx_max:.3f} ∉ [{low},{high}])")
+
+
+def save_heatmaps(indices, limits, fmt="png", preview=None):
+    images = render_all(indices, limits, fmt=fmt, preview=preview)
+    for name, data in images.items():
+        output = f"{name}_heatmap.{fmt}"
+        with open(output, "wb") as f:
+            f.write(data)
+        print(f"Сохранено: {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Расчёт вегетационных индексов и тепловых карт по снимку Sentinel-2"
+    )
+    parser.add_argument("tif_path", help="путь к файлу .tif")
+    parser.add_argument("--stream", metavar="OUT_TIF",
+                        help="считать по окнам и сохранить индексы в GeoTIFF")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов для режима --stream")
+    parser.add_argument("--format", choices=("png", "webp"), default="png",
+                        help="формат тепловых карт")
+    parser.add_argument("--preview", type=int, metavar="PX",
+                        help=f"максимальная сторона тепловой карты в пикселях (по умолчанию {PREVIEW_PX})")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="папка дискового кэша индексов (ключ — содержимое файла)")
+    parser.add_argument("--key", help="готовый отпечаток содержимого файла для --cache "
+                                      "(например, хэш загруженных байтов), чтобы не хэшировать файл заново")
+    args = parser.parse_args()
+    if args.workers != 1 and not args.stream:
+        parser.error("--workers работает только вместе с --stream")
+    if args.key and not args.cache:
+        parser.error("--key работает только вместе с --cache")
+
+    tif_path = args.tif_path
+    stream_out = args.stream
+
+    if stream_out:
+        stats = stream_indices(tif_path, stream_out, workers=args.workers)
+        with rasterio.open(stream_out) as dst:
+            scale = max(1, -(-max(dst.height, dst.width) // (args.preview or PREVIEW_PX)))
+            shape = (dst.height // scale or 1, dst.width // scale or 1)
+            indices = {name: dst.read(i, out_shape=shape) for i, name in enumerate(INDEX_RANGES, start=1)}
+        limits = {}
+        for name in INDEX_RANGES:
+            check_range(name, stats.min[name], stats.max[name])
+            limits[name] = (stats.min[name], stats.max[name])
+        save_heatmaps(indices, limits, args.format)
+        print(f"Сохранено: {stream_out}")
+        return
+
+    if args.cache:
+        from index_cache import IndexCache
+
+        cache = IndexCache(args.cache, by_content=True)
+        if args.key:
+            cache.remember(tif_path, args.key)
+        indices = cache.compute(tif_path, INDEX_RANGES)
+        print(f"Кэш: {cache.hits} попаданий, {cache.misses} промахов")
+    else:
+        engine = IndexEngine(INDEX_RANGES.keys())
+        with rasterio.open(tif_path) as src:
+            B = src.read([b + 1 for b in engine.bands])
+            nodata = src.nodata
+
+        indices = engine.compute(B, bands=engine.bands, nodata=nodata)
 
-        plt.figure(figsize=(8, 6))
-        plt.imshow(idx, cmap='viridis')
-        plt.colorbar(label=f"{name} value")
-        plt.title(f"Тепловая карта {name}")
-        output_png = f"{name}_heatmap.png"
-        plt.savefig(output_png, bbox_inches='tight', dpi=300)
-        plt.close()
-        print(f"Сохранено: {output_png}")
+    limits = {}
+    for name in INDEX_RANGES:
+        idx = indices[name]
+        limits[name] = (float(np.nanmin(idx)), float(np.nanmax(idx)))
+        check_range(name, *limits[name])
+    save_heatmaps(indices, limits, args.format, args.preview or PREVIEW_PX)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
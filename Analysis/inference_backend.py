@@ -0,0 +1,255 @@
+"""
+Ускоренные CPU-бэкенды для генератора CR-Net.
+
+``build_backend`` оборачивает ``net_G`` в вызываемый объект
+``(opt, sar) -> tensor`` одного из видов:
+
+    eager        — исходная модель PyTorch;
+    torchscript  — trace + freeze + optimize_for_inference;
+    compile      — torch.compile;
+    onnx         — экспорт в ONNX и ONNX Runtime (нужен onnxruntime).
+
+Дополнительно: ``quantize="int8"`` (динамическое квантование; у CR-Net
+почти все слои свёрточные, а динамически квантуются только Linear,
+поэтому выигрыш обычно мал) или ``"bf16"`` (autocast, имеет смысл на
+CPU с AVX512-BF16/AMX), ``channels_last=True`` — раскладка NHWC.
+
+Собранный бэкенд сверяется с eager на пробном входе; если он не
+собрался или расходится больше допуска, возвращается eager.
+
+Отчёт «точность против скорости» на своих парах::
+
+    python inference_backend.py model.pth opt1.tif sar1.tif [opt2.tif sar2.tif ...] \\
+        --backend eager torchscript onnx --quantize none bf16 --report report.json
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+logger = logging.getLogger("serve")
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+QUANTIZE = (None, "int8", "bf16")
+
+# допустимое расхождение с eager (макс. по модулю, в нормированных единицах)
+DEFAULT_TOLERANCE = 1e-2
+
+
+def example_inputs(size=256, batch=1):
+    return torch.rand(batch, 13, size, size), torch.rand(batch, 2, size, size)
+
+
+class _Wrapped:
+    """Общая обёртка: раскладка входов, autocast и выход float32 на CPU."""
+
+    def __init__(self, fn, channels_last=False, bf16=False):
+        self.fn = fn
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def __call__(self, opt, sar):
+        if self.channels_last:
+            opt = opt.contiguous(memory_format=torch.channels_last)
+            sar = sar.contiguous(memory_format=torch.channels_last)
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.bf16):
+            out = self.fn(opt, sar)
+        return out.float().contiguous()
+
+
+class _OnnxRunner:
+    def __init__(self, net, example, threads=None):
+        import onnxruntime as ort
+
+        fd, self.path = tempfile.mkstemp(suffix=".onnx")
+        os.close(fd)
+        torch.onnx.export(
+            net, example, self.path,
+            input_names=["opt", "sar"], output_names=["pred"],
+            dynamic_axes={n: {0: "batch", 2: "height", 3: "width"} for n in ("opt", "sar", "pred")},
+            opset_version=17,
+        )
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            self.path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, opt, sar):
+        out = self.session.run(
+            None, {"opt": opt.numpy(), "sar": sar.numpy()}
+        )[0]
+        return torch.from_numpy(out)
+
+
+def _build(net, backend, quantize, channels_last, example):
+    net = copy.deepcopy(net).cpu().eval()
+    if quantize == "int8":
+        net = torch.ao.quantization.quantize_dynamic(net, {torch.nn.Linear}, dtype=torch.qint8)
+    if channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    bf16 = quantize == "bf16"
+
+    if backend == "eager":
+        return _Wrapped(net, channels_last, bf16)
+    if backend == "compile":
+        return _Wrapped(torch.compile(net, dynamic=True), channels_last, bf16)
+    if backend == "torchscript":
+        with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+            scripted = torch.jit.trace(net, example, check_trace=False)
+            scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+        return _Wrapped(scripted, channels_last, bf16)
+    if backend == "onnx":
+        if quantize:
+            raise ValueError("onnx: квантование не поддерживается, только float32")
+        return _OnnxRunner(net, example, torch.get_num_threads())
+    raise ValueError(f"неизвестный бэкенд {backend}")
+
+
+def build_backend(net, backend="eager", quantize=None, channels_last=False,
+                  example=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Собирает бэкенд и сверяет его с eager на ``example``. При ошибке
+    сборки или расхождении больше ``tolerance`` возвращает eager.
+    Возвращает (вызываемый объект, фактическое имя конфигурации).
+    """
+    name = describe(backend, quantize, channels_last)
+    eager = _Wrapped(net.eval())
+    if (backend, quantize, channels_last) == ("eager", None, False):
+        return eager, name
+
+    example = example if example is not None else example_inputs()
+    try:
+        runner = _build(net, backend, quantize, channels_last, example)
+        with torch.inference_mode():
+            err = (runner(*example) - eager(*example)).abs().max().item()
+    except Exception:
+        logger.exception(f"backend {name} failed, falling back to eager")
+        return eager, "eager"
+    if not err <= tolerance:
+        logger.warning(f"backend {name}: max abs error {err:.3g} > {tolerance}, falling back to eager")
+        return eager, "eager"
+    logger.info(f"backend {name}: max abs error vs eager {err:.3g}")
+    return runner, name
+
+
+def describe(backend, quantize=None, channels_last=False):
+    return "+".join([backend] + ([quantize] if quantize else []) + (["channels_last"] if channels_last else []))
+
+
+def _timed(fn, inputs, repeats):
+    times = []
+    outputs = []
+    with torch.inference_mode():
+        fn(*inputs[0])  # прогрев / компиляция
+        for _ in range(repeats):
+            outputs = []
+            for opt, sar in inputs:
+                started = time.perf_counter()
+                outputs.append(fn(opt, sar))
+                times.append(time.perf_counter() - started)
+    return outputs, float(np.median(times))
+
+
+def compare(net, inputs, configs, repeats=3, tolerance=DEFAULT_TOLERANCE):
+    """
+    Точность и скорость конфигураций ``(backend, quantize, channels_last)``
+    относительно eager на парах ``inputs`` [(opt, sar), ...] формы (1, C, H, W).
+    Возвращает список записей отчёта.
+    """
+    eager = _Wrapped(net.eval())
+    reference, base = _timed(eager, inputs, repeats)
+    report = []
+    for backend, quantize, channels_last in configs:
+        entry = {"config": describe(backend, quantize, channels_last)}
+        try:
+            runner = _build(net, backend, quantize, channels_last, inputs[0])
+            outputs, seconds = _timed(runner, inputs, repeats)
+        except Exception as exc:
+            entry.update(status="error", error=str(exc))
+            report.append(entry)
+            continue
+        diff = torch.cat([(o - r).flatten() for o, r in zip(outputs, reference)]).abs()
+        entry.update(
+            status="ok" if diff.max().item() <= tolerance else "inaccurate",
+            max_abs_error=diff.max().item(),
+            mean_abs_error=diff.mean().item(),
+            rmse=diff.square().mean().sqrt().item(),
+            ms_per_pair=seconds * 1000,
+            speedup=base / seconds,
+        )
+        report.append(entry)
+    return report
+
+
+def _read_sample(opt_path, sar_path, size):
+    import rasterio
+    from rasterio.windows import Window
+
+    from train_test.dataloader import AlignedDataset
+
+    normalizer = AlignedDataset(cfg={}, filelist=[])
+    with rasterio.open(opt_path) as src_o, rasterio.open(sar_path) as src_s:
+        h, w = min(size, src_o.height), min(size, src_o.width)
+        win = Window((src_o.width - w) // 2, (src_o.height - h) // 2, w, h)
+        opt = normalizer.get_normalized_data(src_o.read(range(1, 14), window=win).astype(np.float32), data_type=2)
+        sar = normalizer.get_normalized_data(src_s.read(window=win).astype(np.float32), data_type=1)
+    return torch.from_numpy(opt)[None], torch.from_numpy(sar)[None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение CPU-бэкендов CR-Net с eager PyTorch")
+    parser.add_argument("checkpoint", help="чекпойнт CR-Net (.pth)")
+    parser.add_argument("pairs", nargs="+", help="пары файлов: optical sar [optical sar ...]")
+    parser.add_argument("--backend", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--quantize", nargs="+", default=["none", "bf16"], choices=["none", "int8", "bf16"])
+    parser.add_argument("--channels-last", action="store_true", help="проверить также раскладку NHWC")
+    parser.add_argument("--size", type=int, default=256, help="размер центрального окна пары")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--report", help="куда сохранить JSON-отчёт")
+    args = parser.parse_args()
+    if len(args.pairs) % 2:
+        parser.error("файлы пар должны идти парами: optical sar")
+
+    from config import CONFIG
+    from models.model_CR_net import ModelCRNet
+
+    net = ModelCRNet(CONFIG).net_G
+    net.load_state_dict(torch.load(args.checkpoint, map_location="cpu")["network"])
+    net.eval()
+
+    inputs = [_read_sample(o, s, args.size) for o, s in zip(args.pairs[::2], args.pairs[1::2])]
+    quantize = [None if q == "none" else q for q in args.quantize]
+    layouts = [False, True] if args.channels_last else [False]
+    configs = [
+        c for c in itertools.product(args.backend, quantize, layouts)
+        if c != ("eager", None, False)
+    ]
+
+    report = compare(net, inputs, configs, args.repeats, args.tolerance)
+    print(f"{'конфигурация':32} {'статус':10} {'макс. ошибка':>12} {'RMSE':>10} {'мс/пара':>10} {'ускорение':>9}")
+    for r in report:
+        if r["status"] == "error":
+            print(f"{r['config']:32} {'error':10} {r['error']}")
+            continue
+        print(f"{r['config']:32} {r['status']:10} {r['max_abs_error']:12.3g} {r['rmse']:10.3g} "
+              f"{r['ms_per_pair']:10.1f} {r['speedup']:9.2f}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Фоновые задачи для долгих запросов serve.py (экспорт из Earth Engine,
+инференс CR-Net).
+
+Задача получает идентификатор сразу, а выполняется в ограниченном пуле
+потоков своего вида. Состояние каждой задачи — JSON-файл в каталоге
+хранилища, запись атомарная (временный файл + ``os.replace``), так что
+статус и результат переживают перезапуск сервера; задачи, которые
+на момент остановки ещё шли, после запуска помечаются как прерванные.
+
+Одинаковые задачи (тот же вид и тот же payload), пока первая не
+завершилась, не запускаются повторно — возвращается её идентификатор.
+Записи завершённых задач живут до ``sweep(ttl)``.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger("serve")
+
+ACTIVE = ("queued", "running")
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+def job_key(kind, payload):
+    blob = json.dumps({"kind": kind, "payload": payload}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class JobStore:
+    """Задачи на диске: ``<root>/<id>.json``."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, job_id):
+        return self.root / f"{job_id}.json"
+
+    def save(self, job):
+        path = self.path(job["id"])
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def load(self, job_id):
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def all(self):
+        for path in self.root.glob("*.json"):
+            job = self.load(path.stem)
+            if job is not None:
+                yield job
+
+
+class JobManager:
+    """
+    Очередь задач по видам. ``register(kind, fn, workers, max_pending)``
+    заводит пул для вида; ``fn(payload, progress)`` выполняет задачу
+    и возвращает JSON-совместимый результат, ``progress(done, total)``
+    обновляет прогресс. ``submit`` возвращает (задача, создана ли новая).
+    """
+
+    def __init__(self, root):
+        self.store = JobStore(root)
+        self._kinds = {}
+        self._active = {}  # ключ задачи -> id
+        self._jobs = {}  # id -> запись активной задачи
+        self._lock = threading.Lock()
+
+        for job in self.store.all():
+            if job["status"] in ACTIVE:
+                job.update(status="failed", error="interrupted by server restart",
+                           finished=time.time())
+                self.store.save(job)
+
+    def register(self, kind, fn, workers=1, max_pending=32):
+        pool = ThreadPoolExecutor(workers, thread_name_prefix=f"jobs-{kind}")
+        self._kinds[kind] = (fn, pool, max_pending)
+
+    def submit(self, kind, payload, on_finish=None):
+        """
+        ``on_finish(job)`` вызывается в потоке задачи после её завершения
+        с любым статусом (например, удалить входные файлы); для дубликата
+        уже идущей задачи не вызывается.
+        """
+        fn, pool, max_pending = self._kinds[kind]
+        key = job_key(kind, payload)
+        with self._lock:
+            job_id = self._active.get(key)
+            if job_id is not None:
+                return dict(self._jobs[job_id]), False
+            pending = sum(j["kind"] == kind for j in self._jobs.values())
+            if pending >= max_pending:
+                raise QueueFull(f"{kind}: {pending} jobs already queued or running")
+            job = {
+                "id": uuid.uuid4().hex,
+                "kind": kind,
+                "key": key,
+                "status": "queued",
+                "payload": payload,
+                "progress": {"done": 0, "total": None},
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "result": None,
+                "error": None,
+            }
+            self._active[key] = job["id"]
+            self._jobs[job["id"]] = job
+            self.store.save(job)
+        pool.submit(self._run, job, fn, on_finish)
+        return dict(job), True
+
+    def pending(self, kind):
+        """Задач вида ``kind`` в очереди и в работе."""
+        with self._lock:
+            return sum(j["kind"] == kind for j in self._jobs.values())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self.store.load(job_id)
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+            self.store.save(job)
+
+    def sweep(self, ttl):
+        """Удаляет записи задач, завершившихся больше ``ttl`` секунд назад."""
+        cutoff = time.time() - ttl
+        removed = 0
+        for job in self.store.all():
+            if job["status"] not in ACTIVE and (job.get("finished") or 0) < cutoff:
+                self.store.path(job["id"]).unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def _run(self, job, fn, on_finish=None):
+        last_saved = [0.0]
+
+        def progress(done, total=None):
+            # прогресс пишется на диск не чаще раза в секунду
+            with self._lock:
+                job["progress"] = {"done": done, "total": total}
+                now = time.monotonic()
+                if now - last_saved[0] >= 1 or (total is not None and done >= total):
+                    last_saved[0] = now
+                    self.store.save(job)
+
+        self._update(job, status="running", started=time.time())
+        try:
+            result = fn(job["payload"], progress)
+        except Exception as exc:
+            logger.exception(f"job {job['id']} ({job['kind']}) failed")
+            self._update(job, status="failed", error=str(exc), finished=time.time())
+        else:
+            self._update(job, status="done", result=result, finished=time.time())
+        finally:
+            with self._lock:
+                self._active.pop(job["key"], None)
+                self._jobs.pop(job["id"], None)
+            if on_finish is not None:
+                try:
+                    on_finish(dict(job))
+                except Exception:
+                    logger.exception(f"job {job['id']} ({job['kind']}): on_finish failed")
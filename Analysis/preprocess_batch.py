@@ -0,0 +1,194 @@
+"""
+Пакетная предобработка многих продуктов .SAFE.
+
+Каждая цепочка (S2: ресемплинг, S1: шумы → ортокоррекция → калибровка → дБ)
+собирается в один граф SNAP и выполняется целиком утилитой ``gpt`` в
+отдельном процессе со своими размерами кучи JVM и кэша тайлов. Продукты
+раздаются ограниченному пулу таких процессов.
+
+Манифест — JSON-список записей::
+
+    [{"input": "S2A_...SAFE", "output": "out/S2.tif", "type": "S2", "aoi": "field.kml"}, ...]
+
+``type`` можно не указывать — он определяется по имени продукта (S1*/S2*),
+``aoi`` необязателен.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from cropper import aoi_wkt
+from product_store import OutputStore
+
+
+def _node(graph, node_id, operator, source=None, **params):
+    node = ET.SubElement(graph, "node", id=node_id)
+    ET.SubElement(node, "operator").text = operator
+    sources = ET.SubElement(node, "sources")
+    if source:
+        ET.SubElement(sources, "sourceProduct", refid=source)
+    parameters = ET.SubElement(node, "parameters")
+    for key, value in params.items():
+        ET.SubElement(parameters, key).text = str(value).lower() if isinstance(value, bool) else str(value)
+    return node_id
+
+
+def sentinel2_graph(input_path, output_path, aoi=None):
+    graph = ET.Element("graph", id="Sentinel2")
+    ET.SubElement(graph, "version").text = "1.0"
+    last = _node(graph, "Read", "Read", file=os.path.abspath(input_path))
+    if aoi is not None:
+        last = _node(graph, "Subset", "Subset", last,
+                     geoRegion=aoi_wkt(aoi), copyMetadata=True, referenceBand="B2")
+    last = _node(graph, "Resample", "Resample", last,
+                 targetResolution=10, upsampling="Bilinear")
+    _node(graph, "Write", "Write", last,
+          file=os.path.abspath(output_path), formatName="GeoTIFF")
+    return graph
+
+
+def sentinel1_graph(input_path, output_path, aoi=None):
+    graph = ET.Element("graph", id="Sentinel1")
+    ET.SubElement(graph, "version").text = "1.0"
+    last = _node(graph, "Read", "Read", file=os.path.abspath(input_path))
+    last = _node(graph, "Resample", "Resample", last,
+                 targetResolution=10, upsampling="Bilinear")
+    last = _node(graph, "ThermalNoiseRemoval", "ThermalNoiseRemoval", last)
+    last = _node(graph, "Remove-GRD-Border-Noise", "Remove-GRD-Border-Noise", last)
+    if aoi is not None:
+        last = _node(graph, "Subset", "Subset", last, geoRegion=aoi_wkt(aoi), copyMetadata=True)
+    last = _node(graph, "Terrain-Correction", "Terrain-Correction", last, pixelSpacingInMeter=10.0)
+    last = _node(graph, "Calibration", "Calibration", last, outputSigmaBand=True)
+    last = _node(graph, "LinearToFromdB", "LinearToFromdB", last)
+    _node(graph, "Write", "Write", last,
+          file=os.path.abspath(output_path), formatName="GeoTIFF")
+    return graph
+
+
+GRAPHS = {"S1": sentinel1_graph, "S2": sentinel2_graph}
+
+
+def find_gpt():
+    gpt = os.environ.get("SNAP_GPT") or shutil.which("gpt")
+    if not gpt and os.environ.get("SNAPPY_HOME"):
+        gpt = os.path.join(os.environ["SNAPPY_HOME"], "bin", "gpt")
+    if not gpt or not os.path.exists(gpt):
+        raise FileNotFoundError("Не найден gpt из ESA SNAP: задайте SNAP_GPT или SNAPPY_HOME")
+    return gpt
+
+
+def product_type(entry):
+    kind = entry.get("type") or Path(entry["input"]).name[:2].upper()
+    if kind not in GRAPHS:
+        raise ValueError(f"{entry['input']}: неизвестный тип продукта {kind}")
+    return kind
+
+
+def graph_params(graph):
+    """Параметры всех узлов графа без путей к файлам — для ключа хранилища."""
+    return {
+        node.get("id"): {p.tag: p.text for p in node.find("parameters") if p.tag != "file"}
+        for node in graph.findall("node")
+    }
+
+
+def run_graph(graph, heap="8G", tile_cache="4G", threads=None, gpt=None):
+    """Выполняет граф одним вызовом gpt в отдельном процессе."""
+    with tempfile.NamedTemporaryFile("wb", suffix=".xml", delete=False) as f:
+        ET.ElementTree(graph).write(f, encoding="utf-8")
+        graph_path = f.name
+    cmd = [gpt or find_gpt(), f"-J-Xmx{heap}", "-c", tile_cache]
+    if threads:
+        cmd += ["-q", str(threads)]
+    cmd.append(graph_path)
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as exc:
+        raise RuntimeError(exc.stderr.strip() or exc.stdout.strip()) from exc
+    finally:
+        os.remove(graph_path)
+
+
+def process_batch(entries, workers=2, heap="8G", tile_cache="4G", threads=None, store=None):
+    """
+    Обрабатывает продукты манифеста пулом из ``workers`` процессов gpt.
+    С хранилищем ``store`` уже обработанные с теми же параметрами
+    продукты не пересчитываются (статус "cached").
+    Возвращает отчёт: по записи на продукт со временем и статусом.
+    """
+    gpt = find_gpt()
+    if store is not None and not isinstance(store, OutputStore):
+        store = OutputStore(store)
+
+    def job(entry):
+        started = time.perf_counter()
+        report = {"input": entry.get("input"), "output": entry.get("output")}
+        try:
+            missing = [k for k in ("input", "output") if not entry.get(k)]
+            if missing:
+                raise ValueError(f"в записи манифеста нет {', '.join(missing)}")
+            kind = product_type(entry)
+            report["type"] = kind
+            Path(entry["output"]).parent.mkdir(parents=True, exist_ok=True)
+            if store is None:
+                graph = GRAPHS[kind](entry["input"], entry["output"], entry.get("aoi"))
+                run_graph(graph, heap, tile_cache, threads, gpt)
+                report["status"] = "ok"
+            else:
+                params = graph_params(GRAPHS[kind]("", "", entry.get("aoi")))
+                key = store.key(f"{kind}-graph", entry["input"], params)
+                report["status"] = "cached"
+                if store.get(key) is None:
+                    partial = store.partial_path(key)
+                    try:
+                        graph = GRAPHS[kind](entry["input"], partial, entry.get("aoi"))
+                        run_graph(graph, heap, tile_cache, threads, gpt)
+                        store.commit(partial, key)
+                    except BaseException:
+                        # недописанный вывод gpt может весить гигабайты
+                        partial.unlink(missing_ok=True)
+                        raise
+                    report["status"] = "ok"
+                store.export(key, entry["output"])
+        except Exception as exc:
+            report["status"] = "error"
+            report["error"] = str(exc)
+        report["seconds"] = round(time.perf_counter() - started, 1)
+        print(f"{report.get('type', '??')} {Path(str(report['input'])).name}: "
+              f"{report['status']} за {report['seconds']} с")
+        return report
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(job, entries))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пакетная предобработка Sentinel-1/2 в ESA SNAP")
+    parser.add_argument("manifest", help="JSON-манифест продуктов")
+    parser.add_argument("--workers", type=int, default=2, help="число одновременных процессов gpt")
+    parser.add_argument("--heap", default="8G", help="максимальная куча JVM на процесс (-Xmx)")
+    parser.add_argument("--tile-cache", default="4G", help="размер кэша тайлов SNAP на процесс")
+    parser.add_argument("--threads", type=int, help="потоков вычислений на процесс")
+    parser.add_argument("--store", help="хранилище результатов: пропускать уже обработанные продукты")
+    parser.add_argument("--report", help="куда сохранить JSON-отчёт с временем по продуктам")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        entries = json.load(f)
+
+    started = time.perf_counter()
+    report = process_batch(entries, args.workers, args.heap, args.tile_cache, args.threads, args.store)
+    failed = sum(r["status"] == "error" for r in report)
+    print(f"Готово: {len(report) - failed} из {len(report)} за {time.perf_counter() - started:.1f} с")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -1,66 +1,246 @@
-from snappy import ProductIO, GPF, HashMap, ProgressMonitor
+import os
+import re
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, from_bounds
+from shapely import wkt
+from shapely.geometry import mapping, shape
+
+from cropper import aoi_wkt
+from product_store import OutputStore
+
+RESAMPLE_PARAMS = {"targetResolution": 10.0, "resamplingType": "BILINEAR"}
+TERRAIN_CORRECTION_PARAMS = {"pixelSpacingInMeter": 10.0}
+CALIBRATION_PARAMS = {"outputSigmaBand": True}
+
+# порядок каналов на выходе — как у Resample в SNAP
+S2_BANDS = ("B1", "B2", "B3", "B4", "B5", "B6", "B7",
+            "B8", "B8A", "B9", "B10", "B11", "B12")
+
+_snappy = None
+_snappy_lock = threading.Lock()
+
+
+def _snap():
+    """
+    Модуль snappy с загруженными операторами GPF. JVM поднимается
+    при первом обращении, а не при импорте preprocessing.
+    """
+    global _snappy
+    with _snappy_lock:
+        if _snappy is None:
+            import snappy
+
+            snappy.GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+            _snappy = snappy
+    return _snappy
+
+
+def _hashmap(params):
+    hm = _snap().HashMap()
+    for key, value in params.items():
+        hm.put(key, value)
+    return hm
+
+
+def _open_store(store):
+    store = store or os.environ.get("PREPROC_STORE")
+    if store is None or isinstance(store, OutputStore):
+        return store
+    return OutputStore(store)
+
+
+def _write_stored(chain, input_path, output_path, params, store, write):
+    """
+    Пишет результат ``write(path)`` в ``output_path``. Если задано
+    хранилище и в нём уже есть результат для этого продукта с теми же
+    параметрами, обработка не запускается вовсе.
+    """
+    store = _open_store(store)
+    if store is None:
+        write(output_path)
+        return output_path
+
+    key = store.key(chain, input_path, params)
+    if store.get(key) is None:
+        partial = store.partial_path(key)
+        try:
+            write(str(partial))
+            store.commit(partial, key)
+        except BaseException:
+            # недописанный результат не должен оставаться в хранилище
+            partial.unlink(missing_ok=True)
+            raise
+    return store.export(key, output_path)
+
+
+def subset(product, aoi, reference_band=None):
+    params = {"geoRegion": aoi_wkt(aoi), "copyMetadata": True}
+    if reference_band:
+        params["referenceBand"] = reference_band
+    return _snap().GPF.createProduct("Subset", _hashmap(params), product)
 
-GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
 
 def write_product(product, output_path):
-    ProductIO.writeProduct(product, output_path, "GeoTIFF")
-
-
-def process_sentinel2(input_path, output_path):
-    product = ProductIO.readProduct(input_path)
-    params = HashMap()
-    params.put("targetResolution", 10.0)
-    params.put("resamplingType", "BILINEAR")
-    resampled = GPF.createProduct("Resample", params, product)
-    write_product(resampled, output_path)
-
-
-def process_sentinel1(input_path, output_path):
-    product = ProductIO.readProduct(input_path)
-
-    params_res = HashMap()
-    params_res.put("targetResolution", 10.0)
-    params_res.put("resamplingType", "BILINEAR")
-    resampled = GPF.createProduct("Resample", params_res, product)
-
-    tnr = GPF.createProduct("ThermalNoiseRemoval", HashMap(), resampled)
-
-    bnr = GPF.createProduct("Remove-GRD-Border-Noise", HashMap(), tnr)
-
-    params_tc = HashMap()
-    params_tc.put("pixelSpacingInMeter", 10.0)
-    tc = GPF.createProduct("Terrain-Correction", params_tc, bnr)
-
-    params_cal = HashMap()
-    params_cal.put("outputSigmaBand", True)
-    cal = GPF.createProduct("Calibration", params_cal, tc)
-
-    sigma_bands = [b for b in cal.getBandNames() if b.startswith("Sigma0")]
-    params_db = HashMap()
-    params_db.put("sourceBands", sigma_bands)
-    target_db = [b + "_dB" for b in sigma_bands]
-    params_db.put("targetBands", target_db)
-    db = GPF.createProduct("LinearToFromdB", params_db, cal)
-
-    write_product(db, output_path)
+    _snap().ProductIO.writeProduct(product, output_path, "GeoTIFF")
+
+
+def _band_name(src, i):
+    name = src.tags(i).get("BANDNAME") or (src.descriptions[i - 1] or "")
+    name = name.split(",")[0].strip()
+    if not name and src.count == len(S2_BANDS):
+        name = S2_BANDS[i - 1]
+    return name or f"band{i}"
+
+
+def resample_sentinel2_native(input_path, output_path, aoi=None, resolution=10.0):
+    """
+    Ресемплинг всех каналов S2 на сетку 10 м билинейно средствами
+    GDAL (драйвер SENTINEL2 читает .SAFE и .zip), без JVM. Каналы
+    пишутся по одному в порядке S2_BANDS как отражательная способность
+    float32: (DN + RADIO_ADD_OFFSET) / QUANTIFICATION_VALUE, nodata → NaN.
+    """
+    with rasterio.open(input_path) as root:
+        names = [sd for sd in root.subdatasets if re.search(r":(10|20|60)m:", sd)]
+        # у готового GeoTIFF коэффициента нет — значения не пересчитываются
+        quantification = float(root.tags().get("QUANTIFICATION_VALUE", 1))
+        sources = [rasterio.open(sd) for sd in names] if names else [rasterio.open(input_path)]
+
+    try:
+        bands = {}
+        for src in sources:
+            for i in range(1, src.count + 1):
+                bands.setdefault(_band_name(src, i), (src, i))
+
+        # опорная сетка — 10-метровый набор (или сам растр, если он один)
+        ref = min(sources, key=lambda s: s.res[0])
+        scale = ref.res[0] / resolution
+        transform = ref.transform * Affine.scale(1 / scale)
+        width, height = round(ref.width * scale), round(ref.height * scale)
+        if aoi is not None:
+            # тот же буферизованный охват, что у Subset в SNAP и в ключе хранилища
+            region = mapping(wkt.loads(aoi_wkt(aoi)).segmentize(0.001))
+            bounds = shape(transform_geom("EPSG:4326", ref.crs, region)).bounds
+            win = from_bounds(*bounds, transform=transform).round_offsets().round_lengths()
+            win = win.intersection(Window(0, 0, width, height))
+            transform = rasterio.windows.transform(win, transform)
+            width, height = int(win.width), int(win.height)
+
+        order = [b for b in S2_BANDS if b in bands] + [b for b in bands if b not in S2_BANDS]
+        profile = {
+            "driver": "GTiff", "width": width, "height": height, "count": len(order),
+            "dtype": "float32", "nodata": np.nan, "crs": ref.crs, "transform": transform,
+            "tiled": True, "blockxsize": 512, "blockysize": 512,
+            "compress": "deflate", "predictor": 3, "BIGTIFF": "IF_SAFER",
+        }
+        with rasterio.open(output_path, "w", **profile) as dst:
+            dst.descriptions = tuple(order)
+            for k, name in enumerate(order, start=1):
+                src, i = bands[name]
+                offset = float(src.tags(i).get("RADIO_ADD_OFFSET", 0))
+                with WarpedVRT(src, crs=ref.crs, transform=transform, width=width,
+                               height=height, resampling=Resampling.bilinear) as vrt:
+                    dn = vrt.read(i, out_dtype="float32")
+                valid = dn != (src.nodata if src.nodata is not None else 0)
+                refl = np.full(dn.shape, np.nan, dtype=np.float32)
+                np.divide(dn + offset, quantification, out=refl, where=valid)
+                dst.write(refl, k)
+    finally:
+        for src in sources:
+            src.close()
+    return output_path
+
+
+def process_sentinel2(input_path, output_path, aoi=None, store=None, native=False):
+    """
+    Ресемплинг S2 в 10 м. ``native=True`` — через rasterio/GDAL без SNAP.
+    """
+    aoi_key = aoi_wkt(aoi) if aoi is not None else None
+    if native:
+        params = {"engine": "rasterio", "resolution": 10.0, "resampling": "bilinear", "aoi": aoi_key}
+        return _write_stored(
+            "S2", input_path, output_path, params, store,
+            lambda path: resample_sentinel2_native(input_path, path, aoi),
+        )
+
+    def write(path):
+        snap = _snap()
+        product = snap.ProductIO.readProduct(input_path)
+        if aoi is not None:
+            # мультиразрешающий продукт режется по сетке 10-метрового B2
+            product = subset(product, aoi, reference_band="B2")
+        write_product(snap.GPF.createProduct("Resample", _hashmap(RESAMPLE_PARAMS), product), path)
+
+    params = {
+        "resample": RESAMPLE_PARAMS,
+        "aoi": aoi_key,
+    }
+    return _write_stored("S2", input_path, output_path, params, store, write)
+
+
+def process_sentinel1(input_path, output_path, aoi=None, store=None):
+    def write(path):
+        snap = _snap()
+        GPF, HashMap = snap.GPF, snap.HashMap
+        product = snap.ProductIO.readProduct(input_path)
+
+        resampled = GPF.createProduct("Resample", _hashmap(RESAMPLE_PARAMS), product)
+
+        tnr = GPF.createProduct("ThermalNoiseRemoval", HashMap(), resampled)
+
+        bnr = GPF.createProduct("Remove-GRD-Border-Noise", HashMap(), tnr)
+
+        # тепловой и граничный шум снимаются по всей сцене, дальше — только AOI
+        if aoi is not None:
+            bnr = subset(bnr, aoi)
+
+        tc = GPF.createProduct("Terrain-Correction", _hashmap(TERRAIN_CORRECTION_PARAMS), bnr)
+
+        cal = GPF.createProduct("Calibration", _hashmap(CALIBRATION_PARAMS), tc)
+
+        sigma_bands = [b for b in cal.getBandNames() if b.startswith("Sigma0")]
+        params_db = HashMap()
+        params_db.put("sourceBands", sigma_bands)
+        target_db = [b + "_dB" for b in sigma_bands]
+        params_db.put("targetBands", target_db)
+        write_product(GPF.createProduct("LinearToFromdB", params_db, cal), path)
+
+    params = {
+        "resample": RESAMPLE_PARAMS,
+        "terrain_correction": TERRAIN_CORRECTION_PARAMS,
+        "calibration": CALIBRATION_PARAMS,
+        "db": True,
+        "aoi": aoi_wkt(aoi) if aoi is not None else None,
+    }
+    return _write_stored("S1", input_path, output_path, params, store, write)
 
 
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) < 4:
+    args = [a for a in sys.argv[1:] if a != "--native"]
+    if len(args) < 3:
         print("Использование:")
-        print("  python preprocess.py <S2_input> <S1_input> <output_folder>")
+        print("  python preprocess.py <S2_input> <S1_input> <output_folder> [AOI] [--native]")
+        print("  (--native — ресемплинг S2 через rasterio без SNAP;")
+        print("   PREPROC_STORE=<папка> — не пересчитывать уже обработанные продукты)")
         sys.exit(1)
 
-    s2_input = sys.argv[1]
-    s1_input = sys.argv[2]
-    out_folder = sys.argv[3].rstrip("/")
+    s2_input = args[0]
+    s1_input = args[1]
+    out_folder = args[2].rstrip("/")
+    aoi = args[3] if len(args) > 3 else None
 
     s2_out = f"{out_folder}/S2_resampled.tif"
     s1_out = f"{out_folder}/S1_preprocessed_dB.tif"
 
-    process_sentinel2(s2_input, s2_out)
-    process_sentinel1(s1_input, s1_out)
+    process_sentinel2(s2_input, s2_out, aoi, native="--native" in sys.argv)
+    process_sentinel1(s1_input, s1_out, aoi)
 
-    print("Все операции успешно завершены.")
\ No newline at end of file
+    print("Все операции успешно завершены.")
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+# меняется, если меняется сама цепочка обработки
+STORE_VERSION = 1
+
+
+# сколько байт с начала и с конца файла входит в отпечаток содержимого
+SAMPLE_BYTES = 1 << 20
+
+
+def product_id(input_path):
+    """
+    Идентификатор продукта: имя .SAFE/.zip без расширения. Имя каталога
+    .SAFE уникально само по себе; у файла (.zip, GeoTIFF) к имени
+    добавляется отпечаток содержимого — одноимённые загрузки разных
+    пользователей не должны получить один ключ.
+    """
+    path = Path(os.path.normpath(str(input_path)))
+    name = path.name
+    for ext in (".zip", ".SAFE", ".safe"):
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+    if path.is_file():
+        name = f"{name}_{content_fingerprint(path)}"
+    return name
+
+
+def content_fingerprint(path):
+    """
+    Отпечаток файла: размер и хэш первого и последнего ``SAMPLE_BYTES``.
+    Хвост .zip — центральный каталог с CRC32 всех файлов архива, так что
+    разное содержимое почти наверняка даёт разный отпечаток.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(str(size).encode(), digest_size=8)
+    with open(path, "rb") as f:
+        h.update(f.read(SAMPLE_BYTES))
+        if size > SAMPLE_BYTES:
+            f.seek(max(SAMPLE_BYTES, size - SAMPLE_BYTES))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class OutputStore:
+    """
+    Хранилище результатов предобработки с адресацией по содержимому.
+
+    Ключ — идентификатор входного продукта (``product_id``) и хэш
+    параметров операторов (разрешение, ресемплинг, калибровка, AOI …).
+    Результат сначала пишется во временный файл рядом с итоговым
+    и переносится на место через ``os.replace``, поэтому параллельные
+    процессы никогда не видят недописанный GeoTIFF.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(self, chain, input_path, params):
+        blob = json.dumps({"version": STORE_VERSION, "chain": chain, "params": params},
+                          sort_keys=True, default=str)
+        digest = hashlib.sha256(blob.encode()).hexdigest()[:16]
+        return f"{product_id(input_path)}_{chain}_{digest}"
+
+    def path(self, key):
+        return self.root / f"{key}.tif"
+
+    def get(self, key):
+        path = self.path(key)
+        return path if path.exists() else None
+
+    def partial_path(self, key):
+        return self.root / f"{key}.{uuid.uuid4().hex[:8]}.partial.tif"
+
+    def commit(self, partial, key):
+        path = self.path(key)
+        # запись в хранилище только для чтения: её не испортить через r+
+        os.chmod(partial, 0o444)
+        os.replace(partial, path)
+        return path
+
+    def export(self, key, output_path):
+        """
+        Отдаёт копию сохранённого результата по пути ``output_path``.
+        Именно копию, а не жёсткую ссылку: правка выходного файла
+        на месте не должна менять запись хранилища.
+        """
+        src = self.path(key)
+        output_path = Path(output_path)
+        if output_path.resolve() == src.resolve():
+            return output_path
+        tmp = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex[:8]}.partial")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, output_path)
+        return output_path
@@ -0,0 +1,226 @@
+"""
+Несколько CPU-реплик CR-Net в отдельных процессах.
+
+Каждая реплика закреплена за своим набором ядер (``sched_setaffinity``;
+есть только в Linux, на других ОС ядра делятся без закрепления), число
+intra-op потоков torch равно числу её ядер, inter-op — один поток, так
+что параллельные запросы не дерутся за одни и те же ядра. Веса
+загружаются один раз в родителе, переводятся в разделяемую память
+и подставляются в модели реплик без копирования (``assign=True``);
+ускоренные бэкенды (TorchScript и др.) могут держать свою копию.
+
+Процессы запускаются через spawn. По умолчанию spawn заново исполняет
+в дочернем процессе главный модуль родителя (как ``__mp_main__``), то есть
+весь serve.py с импортом KServe и FastAPI; поэтому на время запуска
+реплик главный модуль от multiprocessing прячется (``_bare_main``), и
+реплика импортирует только этот модуль, config и модель.
+"""
+
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import torch
+import torch.multiprocessing as mp
+
+logger = logging.getLogger("serve")
+
+
+def partition_cores(replicas, cores=None):
+    """Делит доступные процессу ядра на ``replicas`` непрерывных наборов."""
+    if not cores:
+        # sched_getaffinity есть только в Linux; на macOS и Windows — все ядра
+        cores = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    cores = sorted(cores)
+    replicas = max(1, min(replicas, len(cores)))
+    size, extra = divmod(len(cores), replicas)
+    chunks, start = [], 0
+    for i in range(replicas):
+        end = start + size + (i < extra)
+        chunks.append(cores[start:end])
+        start = end
+    return chunks
+
+
+@contextlib.contextmanager
+def _bare_main():
+    # без __spec__ и __file__ у __main__ spawn не переисполняет его в потомке;
+    # всё, что нужно реплике, берётся из этого модуля
+    main = sys.modules["__main__"]
+    saved = {k: main.__dict__[k] for k in ("__spec__", "__file__") if k in main.__dict__}
+    main.__spec__ = None
+    main.__dict__.pop("__file__", None)
+    try:
+        yield
+    finally:
+        main.__dict__.pop("__spec__", None)
+        main.__dict__.update(saved)
+
+
+def _replica_main(index, cores, state, backend, example_size, inbox, outbox):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+    try:
+        from config import CONFIG
+        from inference_backend import build_backend, example_inputs
+        from models.model_CR_net import ModelCRNet
+
+        net = ModelCRNet(CONFIG).net_G
+        net.load_state_dict(state, assign=True)
+        net.eval()
+        fn, name = build_backend(net, *backend, example=example_inputs(example_size))
+    except Exception as exc:
+        outbox.put(("failed", index, repr(exc)))
+        raise
+    outbox.put(("ready", index, name))
+
+    with torch.inference_mode():
+        while True:
+            item = inbox.get()
+            if item is None:
+                break
+            job, opt, sar = item
+            try:
+                outbox.put(("done", job, fn(opt, sar)))
+            except Exception as exc:
+                outbox.put(("error", job, repr(exc)))
+
+
+class ReplicaPool:
+    """
+    Пул процессов-реплик. ``forward(i, opt, sar)`` отправляет батч
+    реплике ``i`` и ждёт результат; балансировка — на стороне
+    вызывающего (см. ``BatcherGroup`` в serve.py).
+    """
+
+    def __init__(self, state_dict, replicas, backend=("eager", None, False),
+                 example_size=256, cores=None, start_timeout=600, max_slots=8):
+        ctx = mp.get_context("spawn")
+        for tensor in state_dict.values():
+            tensor.share_memory_()
+
+        self._outbox = ctx.Queue()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+        self.cores = partition_cores(replicas, cores)
+        self.inboxes = []
+        self.processes = []
+        for i, chunk in enumerate(self.cores):
+            inbox = ctx.Queue()
+            proc = ctx.Process(
+                target=_replica_main,
+                args=(i, chunk, state_dict, tuple(backend), example_size, inbox, self._outbox),
+                name=f"clouds-replica-{i}",
+                daemon=True,
+            )
+            with _bare_main():
+                proc.start()
+            self.inboxes.append(inbox)
+            self.processes.append(proc)
+
+        # входы уходят репликам через заранее выделенные буферы в разделяемой
+        # памяти: по очереди передаётся только дескриптор, а не хранилище
+        # тензора (у вида на полосу растра это была бы вся полоса)
+        self.max_slots = max_slots
+        self._slots = [collections.OrderedDict() for _ in self.processes]
+
+        self.backends = [None] * len(self.processes)
+        try:
+            self._wait_ready(start_timeout)
+        except BaseException:
+            self.close(timeout=1)
+            raise
+
+        self._collector = threading.Thread(
+            target=self._collect, name="replica-collector", daemon=True
+        )
+        self._collector.start()
+
+    def _wait_ready(self, start_timeout):
+        deadline = time.monotonic() + start_timeout
+        while None in self.backends:
+            try:
+                kind, i, payload = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                for i, proc in enumerate(self.processes):
+                    if self.backends[i] is None and not proc.is_alive():
+                        raise RuntimeError(
+                            f"replica {i} exited during startup with code {proc.exitcode}"
+                        )
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"replicas not ready after {start_timeout} s")
+                continue
+            if kind == "failed":
+                raise RuntimeError(f"replica {i} failed to start: {payload}")
+            self.backends[i] = payload
+            logger.info(f"replica {i}: cores={self.cores[i]} backend={payload}")
+
+    def __len__(self):
+        return len(self.processes)
+
+    def _collect(self):
+        while True:
+            kind, job, payload = self._outbox.get()
+            with self._lock:
+                fut = self._futures.pop(job, None)
+            if fut is None:
+                continue
+            if kind == "done":
+                fut.set_result(payload)
+            else:
+                fut.set_exception(RuntimeError(payload))
+
+    def _slot(self, index, k, tensor):
+        slots = self._slots[index]
+        key = (k, tuple(tensor.shape), tensor.dtype)
+        slot = slots.pop(key, None)
+        if slot is None:
+            slot = torch.empty(tensor.shape, dtype=tensor.dtype).share_memory_()
+            while len(slots) >= self.max_slots:
+                slots.popitem(last=False)
+        slots[key] = slot
+        return slot.copy_(tensor)
+
+    def forward(self, index, opt, sar):
+        """
+        Прогоняет батч через реплику ``index``. Вызовы для одной реплики
+        должны идти последовательно: её входные буферы переиспользуются.
+        """
+        opt, sar = self._slot(index, 0, opt), self._slot(index, 1, sar)
+        fut = Future()
+        job = next(self._ids)
+        with self._lock:
+            self._futures[job] = fut
+        self.inboxes[index].put((job, opt, sar))
+
+        proc = self.processes[index]
+        while True:
+            try:
+                return fut.result(timeout=1.0)
+            except TimeoutError:
+                if not proc.is_alive():
+                    with self._lock:
+                        self._futures.pop(job, None)
+                    raise RuntimeError(
+                        f"replica {index} exited with code {proc.exitcode}"
+                    )
+
+    def close(self, timeout=10):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for proc in self.processes:
+            proc.join(timeout=timeout)
+            if proc.is_alive():
+                proc.terminate()
@@ -14,8 +14,21 @@ KServe-сервер:
 
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from pathlib import Path
 from typing import Dict, List, Optional
 
@@ -25,39 +38,85 @@ import numpy as np
 import rasterio
 import torch
 import xml.etree.ElementTree as ET
+from fastapi import Request
+from fastapi.responses import FileResponse, JSONResponse
+from kserve.model_server import app as rest_app
+try:
+    import python_multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart as python_multipart
+    from multipart.multipart import parse_options_header
 from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
 from rasterio.transform import Affine
 from rasterio.windows import Window
 from shapely.geometry import Polygon, mapping
 from shapely.ops import transform as shp_transform
+from starlette.background import BackgroundTask
 from pyproj import Transformer
 
 from export_roi_batch import export_roi_batch
+from inference_backend import build_backend, example_inputs
+from jobs import JobManager, QueueFull
+from serve_metrics import (
+    BATCH_SIZE, BUFFER_POOL, SamplingProfiler, stage, track_queue,
+)
+from replicas import ReplicaPool
 
 from config import CONFIG
 from models.model_CR_net import ModelCRNet
 from train_test.dataloader import AlignedDataset
 
 
-# ─── EE init ───────────────────────────────────────────────────────────────
-ee.Initialize(opt_url="https://earthengine-highvolume.googleapis.com")
-
-
 # ─── LOGGING ───────────────────────────────────────────────────────────────
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+# Earth Engine и basicConfig — в блоке __main__: на уровне модуля serve.py
+# не делает ничего, кроме определений (его импортируют и без сервера)
 logger = logging.getLogger("serve")
 
 
+@contextmanager
+def _maybe_profile(name: str, payload: Dict):
+    """
+    ``"profile": true`` в payload — запрос идёт под сэмплирующим
+    профилировщиком, стеки сохраняются в ``profile_dir``. Работает,
+    только если в CONFIG включено ``profiling``. Профиль общий на процесс:
+    в него попадают и параллельные запросы (батчер и пулы ввода-вывода
+    общие), поэтому снимать его стоит на ненагруженном сервере.
+    """
+    if not payload.get("profile", False):
+        yield
+        return
+    if not CONFIG.get("profiling", False):
+        logger.warning(f"{name}: profile requested, but profiling is disabled in CONFIG")
+        yield
+        return
+    with SamplingProfiler(CONFIG.get("profile_interval", 0.005)) as prof:
+        yield
+    path = prof.save(
+        Path(CONFIG.get("profile_dir", Path(tempfile.gettempdir()) / "serve_profiles"))
+        / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.folded"
+    )
+    logger.info(f"profile saved: {path}")
+
+
+def _profiled(name: str, fn):
+    """``fn(payload, progress)`` под ``_maybe_profile`` — в том числе для фоновых задач."""
+
+    def run(payload: Dict, progress=None):
+        with _maybe_profile(name, payload):
+            return fn(payload, progress)
+
+    return run
+
+
 # ───────────────────────────── 1. PARSER ───────────────────────────────────
 
 
 class ParserPipeline(kserve.Model):
     def __init__(self):
         super().__init__("parser")
+        self.jobs: Optional[JobManager] = None
         self.ready = True
 
     def load(self) -> bool:
@@ -74,20 +133,11 @@ class ParserPipeline(kserve.Model):
                 else json.loads(raw)
             )
 
-            kml_path = Path(payload["kml"])
-            out_dir = Path(payload.get("out_dir", "./downloads"))
-            out_dir.mkdir(parents=True, exist_ok=True)
-
-            export_roi_batch(
-                kml=kml_path,
-                date=payload.get("date"),
-                start=payload.get("start"),
-                end=payload.get("end"),
-                out_dir=out_dir,
-                scale=int(payload.get("scale", 10)),
-            )
+            if payload.pop("async", False) and self.jobs is not None:
+                return _reply_job(self.name, *self.jobs.submit(self.name, payload))
 
-            files = sorted(str(p) for p in out_dir.glob("*.tif"))
+            with _maybe_profile(self.name, payload):
+                files = self.run_payload(payload)
 
             return {
                 "model_name": self.name,
@@ -117,6 +167,28 @@ class ParserPipeline(kserve.Model):
                 ],
             }
 
+    @staticmethod
+    def run_payload(payload: Dict, progress=None) -> List[str]:
+        kml_path = Path(payload["kml"])
+        out_dir = Path(payload.get("out_dir", "./downloads"))
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        if progress:
+            progress(0, 1)
+        with stage("ee_export"):
+            export_roi_batch(
+                kml=kml_path,
+                date=payload.get("date"),
+                start=payload.get("start"),
+                end=payload.get("end"),
+                out_dir=out_dir,
+                scale=int(payload.get("scale", 10)),
+            )
+        if progress:
+            progress(1, 1)
+
+        return sorted(str(p) for p in out_dir.glob("*.tif"))
+
 
 # ───────────────────────────── 2. CROPPER ──────────────────────────────────
 
@@ -136,6 +208,27 @@ def _reply_error(model_name: str, msg: str) -> Dict:
     }
 
 
+def _reply_job(model_name: str, job: Dict, created: bool = True) -> Dict:
+    return {
+        "model_name": model_name,
+        "id": f"{model_name}-job",
+        "outputs": [
+            {
+                "name": "job_id",
+                "datatype": "BYTES",
+                "shape": [1],
+                "data": [job["id"]],
+            },
+            {
+                "name": "status",
+                "datatype": "BYTES",
+                "shape": [1],
+                "data": [job["status"] if created else f"{job['status']} (duplicate)"],
+            },
+        ],
+    }
+
+
 class CropperPipeline(kserve.Model):
     def __init__(self):
         super().__init__("cropper")
@@ -159,7 +252,8 @@ class CropperPipeline(kserve.Model):
             kml_path = Path(payload["kml"])
             out_dir = Path(payload.get("out_dir", raster_path.parent))
 
-            out_path = export_roi_batch(raster_path, kml_path, out_dir)
+            with _maybe_profile(self.name, payload), stage("crop"):
+                out_path = export_roi_batch(raster_path, kml_path, out_dir)
 
             return {
                 "model_name": self.name,
@@ -185,21 +279,554 @@ class CropperPipeline(kserve.Model):
 _normalizer = AlignedDataset(cfg={}, filelist=[])
 
 
-def _normalize_opt(a: np.ndarray) -> np.ndarray:
-    return _normalizer.get_normalized_data(
-        a.astype(np.float32), data_type=2
-    )
+class BufferPool:
+    """
+    Переиспользуемые float32-буферы по форме. ``acquire`` отдаёт
+    свободный буфер нужной формы или заводит новый, ``release``
+    возвращает его; свободных буферов одной формы хранится не больше
+    ``max_free``. Содержимое выданного буфера не определено.
+    """
+
+    def __init__(self, max_free: int = 8):
+        self.max_free = max_free
+        self.hits = 0
+        self.misses = 0
+        self._free: Dict[tuple, List[np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape) -> np.ndarray:
+        shape = tuple(int(n) for n in shape)
+        with self._lock:
+            free = self._free.get(shape)
+            if free:
+                self.hits += 1
+                return free.pop()
+            self.misses += 1
+        return np.empty(shape, dtype=np.float32)
+
+    @property
+    def free_bytes(self) -> int:
+        with self._lock:
+            return sum(a.nbytes for free in self._free.values() for a in free)
+
+    def release(self, *arrays: np.ndarray) -> None:
+        with self._lock:
+            for a in arrays:
+                free = self._free.setdefault(a.shape, [])
+                if len(free) < self.max_free:
+                    free.append(a)
+
+
+_buffers = BufferPool(CONFIG.get("buffer_pool_size", 8))
+BUFFER_POOL.set_function(lambda: _buffers.free_bytes)
+
+
+def _read_normalized(src, data_type: int, indexes=None, window=None) -> np.ndarray:
+    """
+    Читает растр сразу в float32-буфер из пула (GDAL приводит тип при
+    чтении) и нормализует его на месте. Буфер возвращается в пул через
+    ``_buffers.release``, когда тензоры на нём больше не нужны.
+    """
+    count = len(indexes) if indexes is not None else src.count
+    if window is None:
+        h, w = src.height, src.width
+    else:
+        h, w = int(window.height), int(window.width)
+    buf = _buffers.acquire((count, h, w))
+    with stage("raster_read"):
+        src.read(indexes, out=buf, window=window)
+    with stage("normalize"):
+        _normalize_inplace(buf, data_type)
+    return buf
+
+
+def _normalize_inplace(buf: np.ndarray, data_type: int) -> None:
+    """
+    То же, что ``AlignedDataset.get_normalized_data``, но прямо в буфере
+    и с константами самого датасета (``clip_min``/``clip_max``/``scale``):
+    SAR (1) — обрезка и приведение к [0, max_val] по каналам, оптика (2, 3) —
+    обрезка и деление на scale. Если констант у датасета нет, вызывается
+    его собственная реализация и результат копируется в буфер.
+    """
+    lows = getattr(_normalizer, "clip_min", None)
+    highs = getattr(_normalizer, "clip_max", None)
+    if (lows is None or highs is None or data_type not in (1, 2, 3)
+            or len(lows[data_type - 1]) != buf.shape[0]):
+        res = _normalizer.get_normalized_data(buf, data_type=data_type)
+        if res is not buf:
+            np.copyto(buf, res)
+        return
+
+    lo = np.asarray(lows[data_type - 1], dtype=np.float32)[:, None, None]
+    hi = np.asarray(highs[data_type - 1], dtype=np.float32)[:, None, None]
+    np.clip(buf, lo, hi, out=buf)
+    if data_type == 1:
+        buf -= lo
+        buf *= np.float32(getattr(_normalizer, "max_val", 1)) / (hi - lo)
+    else:
+        buf /= np.float32(getattr(_normalizer, "scale", 10000))
+
+
+def _read_opt(src, window=None) -> np.ndarray:
+    return _read_normalized(src, 2, list(range(1, 14)), window)
+
+
+def _read_sar(src, window=None) -> np.ndarray:
+    return _read_normalized(src, 1, None, window)
+
+
+def _tile_starts(n: int, tile: int, stride: int) -> List[int]:
+    """Начала тайлов вдоль оси; последний прижат к краю, а не обрезан."""
+    if n <= tile:
+        return [0]
+    return list(range(0, n - tile, stride)) + [n - tile]
+
+
+def _blend_window(h: int, w: int, overlap: int) -> np.ndarray:
+    """
+    Веса пикселей тайла: 1 в центре, спад sin² к краям на ширине
+    перекрытия. Спады соседних тайлов в сумме дают 1, а сам вес нигде
+    не равен нулю — края сцены без соседей не теряются при нормировке.
+    """
+
+    def ramp(n: int) -> np.ndarray:
+        r = np.ones(n, dtype=np.float32)
+        k = min(overlap, n // 2)
+        if k:
+            edge = np.sin(np.pi / 2 * (np.arange(k) + 0.5) / k) ** 2
+            r[:k] = edge
+            r[n - k:] = edge[::-1]
+        return r
+
+    return np.outer(ramp(h), ramp(w))
+
+
+class BoundedExecutor:
+    """
+    Пул потоков с ограниченной очередью: ``submit`` блокируется, пока
+    в работе и в ожидании ``max_pending`` задач. Стадия конвейера не
+    накапливает в памяти больше, чем успевает отдать следующая.
+    """
+
+    def __init__(self, workers: int, max_pending: int, name: str = ""):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self._slots.acquire()
+        try:
+            fut = self._pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda _: self._slots.release())
+        return fut
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait)
+
+    def __enter__(self) -> "BoundedExecutor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+class MicroBatcher:
+    """
+    Собирает входы одинаковой формы из одного и из параллельных
+    запросов в общий батч для одного прохода сети.
+
+    Первый пришедший элемент ждёт попутчиков не дольше ``max_delay_ms``;
+    батч уходит раньше, если набралось ``max_batch_size`` элементов.
+    Элементы разной формы в одном окне ожидания считаются отдельными
+    проходами.
+    """
+
+    def __init__(self, fn, max_batch_size: int = 8, max_delay_ms: float = 10.0):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._loop, name="micro-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, *tensors: torch.Tensor) -> Future:
+        fut: Future = Future()
+        with self._pending_lock:
+            self.pending += 1
+        fut.add_done_callback(self._done)
+        self._queue.put((tensors, fut))
+        return fut
+
+    def _done(self, _fut: Future) -> None:
+        with self._pending_lock:
+            self.pending -= 1
+
+    def _collect(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            groups: Dict = {}
+            for tensors, fut in self._collect():
+                key = tuple(tuple(t.shape) for t in tensors)
+                groups.setdefault(key, []).append((tensors, fut))
+
+            for items in groups.values():
+                try:
+                    with torch.inference_mode():
+                        # одиночный элемент — вид без копии
+                        stacked = [
+                            items[0][0][i].unsqueeze(0)
+                            if len(items) == 1
+                            else torch.stack([t[i] for t, _ in items])
+                            for i in range(len(items[0][0]))
+                        ]
+                        BATCH_SIZE.observe(len(items))
+                        with stage("forward"):
+                            out = self.fn(*stacked)
+                    logger.debug(f"batch of {len(items)} | shape={tuple(out.shape)}")
+                    for k, (_, fut) in enumerate(items):
+                        fut.set_result(out[k])
+                except Exception as exc:
+                    for _, fut in items:
+                        fut.set_exception(exc)
+
+
+class BatcherGroup:
+    """
+    Несколько батчеров (по одному на реплику) за одним ``submit``:
+    вход уходит батчеру с наименьшим числом незавершённых элементов.
+    """
+
+    def __init__(self, batchers: List[MicroBatcher]):
+        self.batchers = batchers
+
+    def submit(self, *tensors: torch.Tensor) -> Future:
+        return min(self.batchers, key=lambda b: b.pending).submit(*tensors)
+
+    @property
+    def pending(self) -> int:
+        return sum(b.pending for b in self.batchers)
+
+
+class PredictionWriter:
+    """
+    Запись ``*_pred.tiff`` в настроенной кодировке.
+
+    ``dtype``: "float32"; "float16" — half float средствами GTiff
+    (NBITS=16, читается как float32); "uint16" — отражательная
+    способность ``round((v - offset) / scale)`` с метаданными
+    scale/offset, NaN → nodata 65535.
+    ``layout``: "strip" — как раньше, "tiled" — тайлы ``blocksize``,
+    "cog" — Cloud-Optimized GeoTIFF (пишется тайловый файл рядом,
+    затем копируется драйвером COG). Сжатие идёт во всех ядрах.
+    ``band_by_band=False`` — все каналы одним ``write``.
+    """
+
+    UINT16_NODATA = 65535
+
+    def __init__(
+        self,
+        dtype: str = CONFIG.get("output_dtype", "float32"),
+        scale: float = CONFIG.get("output_scale", 1e-4),
+        offset: float = CONFIG.get("output_offset", 0.0),
+        compress: Optional[str] = CONFIG.get("output_compress", "DEFLATE"),
+        layout: str = CONFIG.get("output_layout", "tiled"),
+        blocksize: int = CONFIG.get("output_blocksize", 512),
+        band_by_band: bool = CONFIG.get("output_band_by_band", False),
+    ):
+        if dtype not in ("float32", "float16", "uint16"):
+            raise ValueError(f"unsupported output dtype {dtype}")
+        if layout not in ("strip", "tiled", "cog"):
+            raise ValueError(f"unsupported output layout {layout}")
+        self.dtype = dtype
+        self.scale = scale
+        self.offset = offset
+        self.compress = compress
+        self.layout = layout
+        self.blocksize = blocksize
+        self.band_by_band = band_by_band
+
+    def profile(self, h: int, w: int, c: int, transform, crs) -> Dict:
+        profile = dict(
+            driver="GTiff",
+            height=h,
+            width=w,
+            count=c,
+            dtype="uint16" if self.dtype == "uint16" else "float32",
+            crs=crs,
+            transform=transform,
+        )
+        if self.dtype == "float16":
+            profile["nbits"] = 16
+        if self.dtype == "uint16":
+            profile["nodata"] = self.UINT16_NODATA
+        if self.layout != "strip":
+            profile.update(
+                tiled=True, blockxsize=self.blocksize, blockysize=self.blocksize
+            )
+        # COG сжимается при копировании, промежуточный файл — нет
+        if self.compress and self.layout != "cog":
+            profile.update(
+                compress=self.compress,
+                predictor=self._predictor(),
+                num_threads="ALL_CPUS",
+                BIGTIFF="IF_SAFER",
+            )
+        return profile
+
+    def _predictor(self) -> int:
+        # half float плохо дружит с разностным предиктором
+        return {"uint16": 2, "float32": 3}.get(self.dtype, 1)
+
+    def encode(self, pred: np.ndarray) -> np.ndarray:
+        if self.dtype != "uint16":
+            return pred
+        v = (pred - self.offset) / self.scale
+        nan = np.isnan(v)
+        np.clip(v, 0, self.UINT16_NODATA - 1, out=v)
+        v[nan] = self.UINT16_NODATA
+        return np.rint(v).astype(np.uint16)
+
+    def open(self, out_path: Path, h: int, w: int, c: int, transform, crs):
+        return _PredictionFile(self, Path(out_path), self.profile(h, w, c, transform, crs))
+
+    def write(self, pred: np.ndarray, out_path: Path, transform, crs) -> Path:
+        c, h, w = pred.shape
+        with self.open(out_path, h, w, c, transform, crs) as dst:
+            dst.write(pred)
+        return out_path
 
 
-def _normalize_sar(a: np.ndarray) -> np.ndarray:
-    return _normalizer.get_normalized_data(
-        a.astype(np.float32), data_type=1
-    )
+class _PredictionFile:
+    """Открытый на запись ``*_pred.tiff``; ``close`` доводит COG до конца."""
+
+    def __init__(self, writer: PredictionWriter, out_path: Path, profile: Dict):
+        self.writer = writer
+        self.out_path = out_path
+        self.path = out_path
+        if writer.layout == "cog":
+            self.path = out_path.with_name(
+                f".{out_path.name}.{uuid.uuid4().hex[:8]}.partial.tif"
+            )
+        self.dst = rasterio.open(self.path, "w", **profile)
+        self._rows: List[np.ndarray] = []
+        self._row0 = 0
+        if writer.dtype == "uint16":
+            self.dst.scales = (writer.scale,) * profile["count"]
+            self.dst.offsets = (writer.offset,) * profile["count"]
+
+    def write(self, pred: np.ndarray, window: Optional[Window] = None) -> None:
+        with stage("geotiff_write"):
+            data = self.writer.encode(pred)
+            if self.writer.band_by_band:
+                for b in range(data.shape[0]):
+                    self.dst.write(data[b], b + 1, window=window)
+            else:
+                self.dst.write(data, window=window)
+
+    def write_rows(self, pred: np.ndarray, row: int) -> None:
+        """
+        Полоса строк ``row…`` на всю ширину; полосы идут подряд сверху
+        вниз. В тайловый файл строки уходят целыми рядами блоков, чтобы
+        сжатые тайлы не переписывались по частям.
+        """
+        if not self.dst.profile.get("tiled"):
+            self.write(pred, Window(0, row, self.dst.width, pred.shape[1]))
+            return
+        if not self._rows:
+            self._row0 = row
+        self._rows.append(pred)
+        end = row + pred.shape[1]
+        bs = self.writer.blocksize
+        cut = end if end == self.dst.height else end // bs * bs
+        if cut <= self._row0:
+            return
+        data = np.concatenate(self._rows, axis=1) if len(self._rows) > 1 else pred
+        n = cut - self._row0
+        self.write(data[:, :n], Window(0, self._row0, self.dst.width, n))
+        self._rows = [data[:, n:]] if end > cut else []
+        self._row0 = cut
+
+    def close(self) -> None:
+        with stage("geotiff_write"):
+            self._close()
+
+    def _close(self) -> None:
+        self.dst.close()
+        if self.path == self.out_path:
+            return
+        w = self.writer
+        try:
+            rio_copy(
+                self.path,
+                self.out_path,
+                driver="COG",
+                compress=w.compress or "NONE",
+                predictor="YES" if w.compress and w.dtype != "float16" else "NO",
+                blocksize=w.blocksize,
+                num_threads="ALL_CPUS",
+                bigtiff="IF_SAFER",
+            )
+        finally:
+            os.remove(self.path)
+
+    def abort(self) -> None:
+        self.dst.close()
+        if self.path != self.out_path:
+            os.remove(self.path)
+
+    def __enter__(self) -> "_PredictionFile":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _MultipartToDisk:
+    """
+    Потоковый разбор multipart/form-data на публичных колбэках
+    python-multipart: файловые части пишутся сразу в ``in_dir``
+    (``<n>_<имя файла>``), без временных файлов и без сборки в памяти.
+    Обычные поля (не больше ``max_field`` байт) собираются строками.
+    ``fields`` и ``files`` — {имя поля: [значения / пути]}.
+    """
+
+    def __init__(self, in_dir: Path, max_field: int = 1 << 20):
+        self.in_dir = in_dir
+        self.max_field = max_field
+        self.fields: Dict[str, List[str]] = {}
+        self.files: Dict[str, List[Path]] = {}
+        self._opened: List = []
+        self._writes: List = []
+        self._header = [b"", b""]
+        self._headers: Dict[bytes, bytes] = {}
+        self._name = ""
+        self._file = None
+        self._data = bytearray()
+
+    async def receive(self, request: Request) -> None:
+        ctype, params = parse_options_header(request.headers.get("content-type", ""))
+        if ctype != b"multipart/form-data" or b"boundary" not in params:
+            raise ValueError("expected multipart/form-data with a boundary")
+        parser = python_multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._part_begin,
+            "on_header_field": lambda data, start, end: self._add_header(0, data[start:end]),
+            "on_header_value": lambda data, start, end: self._add_header(1, data[start:end]),
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        })
+        loop = asyncio.get_running_loop()
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if self._writes:
+                    # запись на диск — вне цикла событий
+                    writes, self._writes = self._writes, []
+                    await loop.run_in_executor(None, self._flush, writes)
+            parser.finalize()
+        finally:
+            for f in self._opened:
+                f.close()
+
+    @staticmethod
+    def _flush(writes: List) -> None:
+        for f, data in writes:
+            f.write(data)
+
+    def _part_begin(self) -> None:
+        self._headers = {}
+        self._file = None
+        self._data = bytearray()
+
+    def _add_header(self, k: int, data: bytes) -> None:
+        self._header[k] += data
+
+    def _header_end(self) -> None:
+        name, value = self._header
+        self._headers[name.lower()] = value
+        self._header = [b"", b""]
+
+    def _headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise ValueError("multipart part without a name")
+        self._name = options[b"name"].decode("utf-8", "replace")
+        if b"filename" in options:
+            n = sum(len(v) for v in self.files.values())
+            filename = Path(options[b"filename"].decode("utf-8", "replace")).name or "upload"
+            path = self.in_dir / f"{n}_{filename}"
+            self._file = open(path, "wb")
+            self._opened.append(self._file)
+            self.files.setdefault(self._name, []).append(path)
+
+    def _part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._file is not None:
+            self._writes.append((self._file, bytes(data[start:end])))
+            return
+        self._data += data[start:end]
+        if len(self._data) > self.max_field:
+            raise ValueError(f"field {self._name} exceeds {self.max_field} bytes")
+
+    def _part_end(self) -> None:
+        if self._file is None:
+            self.fields.setdefault(self._name, []).append(self._data.decode("utf-8", "replace"))
 
 
 class CloudRemovalPipeline(kserve.Model):
-    def __init__(self):
+    def __init__(
+        self,
+        max_batch_size: int = CONFIG.get("max_batch_size", 8),
+        max_batch_delay_ms: float = CONFIG.get("max_batch_delay_ms", 10),
+        tile_size: int = CONFIG.get("tile_size", 0),
+        tile_overlap: int = CONFIG.get("tile_overlap", 64),
+        io_workers: int = CONFIG.get("io_workers", 4),
+        prefetch: Optional[int] = CONFIG.get("prefetch"),
+        replicas: int = CONFIG.get("replicas", 1),
+        writer: Optional[PredictionWriter] = None,
+        upload_dir: str = CONFIG.get(
+            "upload_dir", str(Path(tempfile.gettempdir()) / "clouds_uploads")
+        ),
+    ):
         super().__init__("clouds")
+        self.jobs: Optional[JobManager] = None
+        self.writer = writer or PredictionWriter()
+        track_queue("batcher", lambda: self.batcher.pending)
+        self.upload_dir = Path(upload_dir)
+
+        # по умолчанию сцены считаются целиком; тайловый режим включается
+        # ключом tile_size в CONFIG или в запросе (сцены больше тайла)
+        self.tile_size = tile_size or 0
+        self.tile_overlap = tile_overlap
+
+        # чтение и нормализация следующих пар идут, пока сеть занята
+        # текущими; в работе не больше ``prefetch`` прочитанных пар
+        self.io_workers = io_workers
+        self.prefetch = prefetch or max_batch_size
+        self._io_pool = ThreadPoolExecutor(
+            io_workers, thread_name_prefix="clouds-io"
+        )
 
         if torch.backends.mps.is_available():
             self.device = torch.device("mps")
@@ -209,6 +836,17 @@ class CloudRemovalPipeline(kserve.Model):
             self.device = torch.device("cpu")
 
         self.model_cr = ModelCRNet(CONFIG)
+        self.net = self.model_cr.net_G
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay_ms = max_batch_delay_ms
+        self.batcher = MicroBatcher(
+            self._forward, max_batch_size, max_batch_delay_ms
+        )
+
+        # replicas > 1 (только CPU): модель считают процессы-реплики,
+        # каждая на своих ядрах, см. replicas.py
+        self.replicas = replicas
+        self.pool: Optional[ReplicaPool] = None
         self.ready = False
 
     def load(self) -> bool:
@@ -218,18 +856,70 @@ class CloudRemovalPipeline(kserve.Model):
             return False
 
         state = torch.load(ckpt_path, map_location=self.device)
+        backend_cfg = (
+            CONFIG.get("backend", "eager"),
+            CONFIG.get("quantize"),
+            CONFIG.get("channels_last", False),
+        )
+        example_size = min(self.tile_size or 256, 256)
+
+        if self.replicas > 1 and self.device.type == "cpu":
+            self.pool = ReplicaPool(
+                state["network"], self.replicas, backend_cfg, example_size
+            )
+            self.batcher = BatcherGroup(
+                [
+                    MicroBatcher(
+                        partial(self.pool.forward, i),
+                        self.max_batch_size,
+                        self.max_batch_delay_ms,
+                    )
+                    for i in range(len(self.pool))
+                ]
+            )
+            self.ready = True
+            logger.info(
+                f"CR-Net loaded ({ckpt_path}) | {len(self.pool)} replicas "
+                f"| cores={self.pool.cores} | backend={self.pool.backends}"
+            )
+            return True
+
         self.model_cr.net_G.load_state_dict(state["network"])
         self.model_cr.net_G.eval().to(self.device)
+
+        # ускоренный бэкенд — только на CPU; при сбое остаётся eager
+        backend = "eager"
+        self.net = self.model_cr.net_G
+        if self.device.type == "cpu":
+            self.net, backend = build_backend(
+                self.model_cr.net_G,
+                *backend_cfg,
+                example_inputs(example_size),
+            )
+
         self.ready = True
         logger.info(
-            f"CR-Net loaded ({ckpt_path}) | device={self.device}"
+            f"CR-Net loaded ({ckpt_path}) | device={self.device} | backend={backend}"
         )
         return True
 
-    @torch.no_grad()
-    def predict(
+    def _forward(
+        self, opt_t: torch.Tensor, sar_t: torch.Tensor
+    ) -> torch.Tensor:
+        return self.net(
+            opt_t.to(self.device), sar_t.to(self.device)
+        ).cpu()
+
+    async def predict(
         self, request: kserve.InferRequest, headers=None
     ) -> Dict:
+        # тяжёлая работа — в пуле потоков, чтобы параллельные запросы
+        # доходили до батчера, а не ждали друг друга в event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._predict_sync, request
+        )
+
+    def _predict_sync(self, request: kserve.InferRequest) -> Dict:
         if not self.ready:
             return _reply_error(self.name, "Model not ready")
 
@@ -241,25 +931,11 @@ class CloudRemovalPipeline(kserve.Model):
                 else json.loads(raw)
             )
 
-            pairs: List[Dict] = payload.get("pairs", [])
-            save_root = (
-                Path(payload.get("save_dir", ""))
-                if payload.get("save_dir")
-                else None
-            )
+            if payload.pop("async", False) and self.jobs is not None:
+                return _reply_job(self.name, *self.jobs.submit(self.name, payload))
 
-            if save_root:
-                save_root.mkdir(parents=True, exist_ok=True)
-
-            results: List[str] = []
-            for p in pairs:
-                opt_path = Path(p["optical"])
-                sar_path = Path(p["sar"])
-                results.append(
-                    str(
-                        self._run_pair(opt_path, sar_path, save_root)
-                    )
-                )
+            with _maybe_profile(self.name, payload):
+                results = self.run_payload(payload)
 
             return {
                 "model_name": self.name,
@@ -278,58 +954,475 @@ class CloudRemovalPipeline(kserve.Model):
             logger.exception("Inference failed")
             return _reply_error(self.name, str(exc))
 
-    @torch.no_grad()
-    def _run_pair(
+    def run_payload(self, payload: Dict, progress=None) -> List[str]:
+        """
+        Общая часть /infer, /upload и фоновых задач: ``payload["pairs"]``
+        — пути [{"optical": ..., "sar": ...}] на общем хранилище,
+        остальные ключи — save_dir, tile_size (0 — сцена целиком), tile_overlap.
+        ``progress(done, total)`` вызывается по мере записи пар.
+        """
+        pairs: List[Dict] = payload.get("pairs", [])
+        save_root = (
+            Path(payload.get("save_dir", ""))
+            if payload.get("save_dir")
+            else None
+        )
+
+        if save_root:
+            save_root.mkdir(parents=True, exist_ok=True)
+
+        tile = int(payload.get("tile_size", self.tile_size) or 0)
+        overlap = int(payload.get("tile_overlap", self.tile_overlap))
+
+        # небольшие пары идут через конвейер чтение → батчер → запись,
+        # крупные сцены — по тайлам
+        results: List[Optional[str]] = [None] * len(pairs)
+        small = []
+        for k, p in enumerate(pairs):
+            opt_path = Path(p["optical"])
+            sar_path = Path(p["sar"])
+            if self._needs_tiling(opt_path, tile):
+                continue
+            small.append((k, opt_path, sar_path))
+
+        done = [0]
+        done_lock = threading.Lock()
+
+        def tick(_=None) -> None:
+            if progress:
+                with done_lock:
+                    done[0] += 1
+                    progress(done[0], len(pairs))
+
+        if progress:
+            progress(0, len(pairs))
+
+        for k, out_path in self._run_pairs(small, save_root, tick):
+            results[k] = str(out_path)
+
+        for k, p in enumerate(pairs):
+            if results[k] is None:
+                results[k] = str(
+                    self._run_pair_tiled(
+                        Path(p["optical"]), Path(p["sar"]),
+                        save_root, tile, overlap,
+                    )
+                )
+                tick()
+        return results
+
+    async def upload(self, request: Request):
+        """
+        POST /v2/models/clouds/upload, multipart/form-data.
+
+        Поля: ``optical`` и ``sar`` — GeoTIFF пар (для нескольких пар поля
+        повторяются), ``aoi`` — необязательный контур (снимки режутся
+        по охвату через VRT, без копирования пикселей), ``payload`` —
+        JSON с параметрами как у /infer; ``"return": "file"`` — ответом
+        будет сам ``*_pred.tiff`` единственной пары, а не список путей;
+        ``"async": true`` — сразу вернуть id фоновой задачи.
+
+        Файлы пишутся в ``upload_dir`` прямо из потока запроса, без base64,
+        без сборки запроса в памяти и без промежуточных временных файлов.
+        """
+        if not self.ready:
+            return JSONResponse({"error": "Model not ready"}, 503)
+        if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+            return JSONResponse({"error": "expected multipart/form-data"}, 415)
+
+        job_dir = self.upload_dir / uuid.uuid4().hex
+        (job_dir / "in").mkdir(parents=True)
+        form = _MultipartToDisk(job_dir / "in")
+        try:
+            await form.receive(request)
+            try:
+                payload = json.loads(form.fields.get("payload", ["{}"])[0] or "{}")
+            except ValueError as exc:
+                raise ValueError(f"bad payload: {exc}") from None
+            optical, sar = form.files.get("optical", []), form.files.get("sar", [])
+            if not optical or len(optical) != len(sar):
+                raise ValueError("expected equal numbers of optical and sar files")
+        except ValueError as exc:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return JSONResponse({"error": str(exc)}, 400)
+        except BaseException:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+
+        keep_outputs = bool(payload.get("save_dir"))
+        payload.setdefault("save_dir", str(job_dir / "pred"))
+        background = payload.pop("async", False) and self.jobs is not None
+        loop = asyncio.get_running_loop()
+        try:
+            aoi = form.files.get("aoi", [None])[0]
+            payload["pairs"] = await loop.run_in_executor(
+                None, self._upload_pairs, optical, sar, aoi
+            )
+            if background:
+                # входы лежат на диске до конца задачи, потом удаляются;
+                # результаты в pred/ — до очистки по TTL (sweep_uploads)
+                job, _ = self.jobs.submit(
+                    self.name, payload,
+                    on_finish=lambda _job: self._drop_upload(job_dir, keep_outputs),
+                )
+                return JSONResponse({"job_id": job["id"], "status": job["status"]}, 202)
+            results = await loop.run_in_executor(
+                None, _profiled(self.name, self.run_payload), payload
+            )
+        except QueueFull as exc:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return JSONResponse({"error": str(exc)}, 429)
+        except Exception as exc:
+            logger.exception("Upload inference failed")
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return JSONResponse({"error": str(exc)}, 500)
+        self._drop_upload(job_dir, keep_outputs)
+
+        if payload.get("return") == "file" and len(results) == 1:
+            return FileResponse(
+                results[0],
+                media_type="image/tiff",
+                filename=Path(results[0]).name,
+                background=None if keep_outputs else BackgroundTask(
+                    shutil.rmtree, job_dir, ignore_errors=True
+                ),
+            )
+        return {
+            "model_name": self.name,
+            "id": "clouds-ok",
+            "outputs": [
+                {
+                    "name": "prediction_paths",
+                    "datatype": "STRING",
+                    "shape": [len(results)],
+                    "data": results,
+                }
+            ],
+        }
+
+    @staticmethod
+    def _drop_upload(job_dir: Path, keep_outputs: bool) -> None:
+        # результаты в чужом save_dir — каталог загрузки больше не нужен целиком
+        shutil.rmtree(job_dir if keep_outputs else job_dir / "in", ignore_errors=True)
+
+    def sweep_uploads(self, ttl: float) -> int:
+        """
+        Удаляет каталоги загрузок, в которых ничего не менялось дольше
+        ``ttl`` секунд (брошенные входы и невостребованные результаты).
+        """
+        cutoff = time.time() - ttl
+        removed = 0
+        if not self.upload_dir.is_dir():
+            return removed
+        for job_dir in self.upload_dir.iterdir():
+            try:
+                newest = max(
+                    [job_dir.stat().st_mtime]
+                    + [p.stat().st_mtime for p in job_dir.rglob("*")]
+                )
+            except FileNotFoundError:
+                continue
+            if newest < cutoff:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _upload_pairs(optical: List[Path], sar: List[Path], aoi_path: Optional[Path] = None) -> List[Dict]:
+        # файлы уже лежат на месте (см. _MultipartToDisk); с AOI пары
+        # заменяются VRT-вырезками
+        pairs = []
+        for o, s in zip(optical, sar):
+            paths = [o, s]
+            if aoi_path is not None:
+                from cropper import clip_image
+
+                paths = [
+                    Path(clip_image(p, aoi_path, p.with_suffix(".vrt"), fmt="vrt"))
+                    for p in paths
+                ]
+            pairs.append({"optical": str(paths[0]), "sar": str(paths[1])})
+        return pairs
+
+    @staticmethod
+    def _read_pair(opt_path: Path, sar_path: Path):
+        with rasterio.open(opt_path) as src_o:
+            opt = _read_opt(src_o)
+            transform = src_o.transform
+            crs = src_o.crs
+
+        with rasterio.open(sar_path) as src_s:
+            sar = _read_sar(src_s)
+
+        return opt, sar, transform, crs
+
+    @staticmethod
+    def _pred_path(opt_path: Path, save_root: Optional[Path]) -> Path:
+        return (save_root or opt_path.parent) / f"{opt_path.stem}_pred.tiff"
+
+    def _run_pairs(
+        self, items: List, save_root: Optional[Path], on_written=None
+    ) -> List:
+        """
+        Конвейер для пар ``(k, optical, sar)``: пары читаются
+        и нормализуются в пуле ввода-вывода с опережением на
+        ``self.prefetch``, по мере готовности уходят в батчер,
+        а предсказания пишутся фоновым писателем с ограниченной
+        очередью. Возвращает ``[(k, путь результата)]``.
+        """
+        todo = iter(items)
+        reads: deque = deque()
+
+        def refill() -> None:
+            for k, opt_path, sar_path in islice(todo, self.prefetch - len(reads)):
+                reads.append(
+                    (k, opt_path,
+                     self._io_pool.submit(self._read_pair, opt_path, sar_path))
+                )
+
+        def write(pred: Future, out_path: Path, transform, crs) -> Path:
+            return self.writer.write(pred.result().numpy(), out_path, transform, crs)
+
+        writes = []
+        with BoundedExecutor(
+            self.io_workers, self.prefetch, "clouds-writer"
+        ) as writer:
+            refill()
+            while reads:
+                k, opt_path, fut = reads.popleft()
+                opt, sar, transform, crs = fut.result()
+                refill()
+                pred = self.batcher.submit(
+                    torch.from_numpy(opt), torch.from_numpy(sar)
+                )
+                # после сборки батча буферы входа свободны
+                pred.add_done_callback(
+                    lambda _, bufs=(opt, sar): _buffers.release(*bufs)
+                )
+                del opt, sar
+                written = writer.submit(
+                    write, pred, self._pred_path(opt_path, save_root),
+                    transform, crs,
+                )
+                if on_written:
+                    written.add_done_callback(on_written)
+                writes.append((k, written))
+            return [(k, w.result()) for k, w in writes]
+
+    @staticmethod
+    def _needs_tiling(opt_path: Path, tile: int) -> bool:
+        if tile <= 0:
+            return False
+        with rasterio.open(opt_path) as src:
+            return src.height > tile or src.width > tile
+
+    def _run_pair_tiled(
         self,
         opt_path: Path,
         sar_path: Path,
         save_root: Optional[Path],
+        tile: int,
+        overlap: int,
     ) -> Path:
-        with rasterio.open(opt_path) as src_o:
-            opt = _normalize_opt(src_o.read(range(1, 14)))
-            transform = src_o.transform
-            crs = src_o.crs
+        """
+        Инференс сцены любого размера по перекрывающимся тайлам.
+
+        Сцена читается полосами высотой в тайл, тайлы полосы уходят
+        в батчер вместе. Предсказания складываются с весами
+        ``_blend_window`` в накопитель на одну полосу; строки, которых
+        следующие тайлы уже не коснутся, нормируются на сумму весов
+        и сразу пишутся в GeoTIFF. Память ограничена одной полосой
+        и не зависит от высоты сцены.
+        """
+        out_path = self._pred_path(opt_path, save_root)
+
+        with rasterio.open(opt_path) as src_o, rasterio.open(sar_path) as src_s:
+            h, w = src_o.height, src_o.width
+            if (src_s.height, src_s.width) != (h, w):
+                raise ValueError(
+                    f"{opt_path.name} и {sar_path.name}: разные размеры растров"
+                )
 
-        with rasterio.open(sar_path) as src_s:
-            sar = _normalize_sar(src_s.read())
+            th, tw = min(tile, h), min(tile, w)
+            overlap = max(0, min(overlap, th // 2, tw // 2))
+            rows = _tile_starts(h, th, th - overlap)
+            cols = _tile_starts(w, tw, tw - overlap)
+            weight = _blend_window(th, tw, overlap)
+
+            def read_strip(r0: int):
+                win = Window(0, r0, w, th)
+                return _read_opt(src_o, win), _read_sar(src_s, win)
+
+            dst = None
+            acc = wsum = None
+            top = 0  # первая строка сцены в накопителе
+            writes: List[Future] = []
+
+            def flush(n: int) -> None:
+                # n верхних строк накопителя готовы; делением получается
+                # новый массив, так что накопитель можно сразу сдвигать
+                writes.append(
+                    writer.submit(dst.write_rows, acc[:, :n] / wsum[:n], top)
+                )
 
-        opt_t = torch.from_numpy(opt).unsqueeze(0).to(self.device)
-        sar_t = torch.from_numpy(sar).unsqueeze(0).to(self.device)
+            # следующая полоса читается, пока сеть считает текущую;
+            # по одному потоку на чтение и запись — датасеты rasterio
+            # не потокобезопасны
+            try:
+                with ThreadPoolExecutor(
+                    1, thread_name_prefix="tile-reader"
+                ) as reader, BoundedExecutor(1, 2, "tile-writer") as writer:
+                    nxt = reader.submit(read_strip, rows[0])
+                    for i, r0 in enumerate(rows):
+                        opt, sar = nxt.result()
+                        if i + 1 < len(rows):
+                            nxt = reader.submit(read_strip, rows[i + 1])
+                        futures = [
+                            self.batcher.submit(
+                                torch.from_numpy(opt[:, :, c0:c0 + tw]),
+                                torch.from_numpy(sar[:, :, c0:c0 + tw]),
+                            )
+                            for c0 in cols
+                        ]
+                        strip = (opt, sar)
+                        del opt, sar
+
+                        if acc is not None and r0 > top:
+                            shift = r0 - top
+                            flush(shift)
+                            acc[:, :-shift] = acc[:, shift:]
+                            acc[:, -shift:] = 0
+                            wsum[:-shift] = wsum[shift:]
+                            wsum[-shift:] = 0
+                        top = r0
+
+                        for c0, fut in zip(cols, futures):
+                            pred = fut.result().numpy()
+                            if acc is None:
+                                acc = np.zeros((pred.shape[0], th, w), np.float32)
+                                wsum = np.zeros((th, w), np.float32)
+                                dst = self.writer.open(
+                                    out_path, h, w, pred.shape[0],
+                                    src_o.transform, src_o.crs,
+                                )
+                            acc[:, :, c0:c0 + tw] += pred * weight
+                            wsum[:, c0:c0 + tw] += weight
+                        _buffers.release(*strip)
+
+                    flush(h - top)
+                for fut in writes:
+                    fut.result()
+            except BaseException:
+                if dst is not None:
+                    dst.abort()
+                raise
+            dst.close()
 
-        pred_np = (
-            self.model_cr.net_G(opt_t, sar_t)
-            .squeeze(0)
-            .cpu()
-            .numpy()
+        logger.info(
+            f"tiled inference {opt_path.name}: {len(rows)}x{len(cols)} tiles "
+            f"of {th}x{tw}, overlap {overlap}"
         )
-        out_path = (
-            save_root
-            or opt_path.parent
-        ) / f"{opt_path.stem}_pred.tiff"
+        return out_path
 
-        c, h, w = pred_np.shape
 
-        with rasterio.open(
-            out_path,
-            "w",
-            driver="GTiff",
-            height=h,
-            width=w,
-            count=c,
-            dtype="float32",
-            crs=crs,
-            transform=transform,
-        ) as dst:
-            for b in range(c):
-                dst.write(pred_np[b], b + 1)
+# ───────────────────────────── 4. JOBS ─────────────────────────────────────
+
+
+def register_job_routes(app, jobs: JobManager, models: List) -> None:
+    """
+    POST /v2/models/{name}/jobs        — тело = payload, ответ 202 с id задачи
+    GET  /v2/jobs/{job_id}             — статус и прогресс
+    GET  /v2/jobs/{job_id}/result      — результат (409, пока не готов)
+    GET  /v2/jobs/{job_id}/files/{k}   — k-й файл результата
+    """
+
+    def submitter(name: str):
+        async def submit(request: Request):
+            payload = await request.json()
+            payload.pop("async", None)
+            try:
+                job, created = jobs.submit(name, payload)
+            except QueueFull as exc:
+                return JSONResponse({"error": str(exc)}, 429)
+            return JSONResponse(
+                {"job_id": job["id"], "status": job["status"], "duplicate": not created},
+                202,
+            )
 
-        return out_path
+        return submit
+
+    def status(job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            return JSONResponse({"error": f"unknown job {job_id}"}, 404)
+        return {k: job[k] for k in (
+            "id", "kind", "status", "progress", "created", "started", "finished", "error"
+        )}
+
+    def result(job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            return JSONResponse({"error": f"unknown job {job_id}"}, 404)
+        if job["status"] != "done":
+            return JSONResponse(
+                {"status": job["status"], "error": job["error"]},
+                500 if job["status"] == "failed" else 409,
+            )
+        return {"id": job["id"], "result": job["result"]}
+
+    def result_file(job_id: str, k: int):
+        job = jobs.get(job_id)
+        if job is None:
+            return JSONResponse({"error": f"unknown job {job_id}"}, 404)
+        if job["status"] != "done":
+            return JSONResponse({"status": job["status"], "error": job["error"]}, 409)
+        if not 0 <= k < len(job["result"]):
+            return JSONResponse({"error": f"job {job_id} has no file {k}"}, 404)
+        path = Path(job["result"][k])
+        return FileResponse(path, media_type="image/tiff", filename=path.name)
+
+    for model in models:
+        app.add_api_route(
+            f"/v2/models/{model.name}/jobs", submitter(model.name), methods=["POST"]
+        )
+    app.add_api_route("/v2/jobs/{job_id}", status, methods=["GET"])
+    app.add_api_route("/v2/jobs/{job_id}/result", result, methods=["GET"])
+    app.add_api_route("/v2/jobs/{job_id}/files/{k}", result_file, methods=["GET"])
+
+
+def start_cleanup(jobs: JobManager, clouds, ttl: float, interval: float) -> threading.Thread:
+    """
+    Фоновая очистка раз в ``interval`` секунд: записи задач и каталоги
+    загрузок старше ``ttl`` секунд.
+    """
+
+    def loop() -> None:
+        while True:
+            try:
+                n_jobs = jobs.sweep(ttl)
+                n_uploads = clouds.sweep_uploads(ttl)
+                if n_jobs or n_uploads:
+                    logger.info(f"cleanup: {n_jobs} job records, {n_uploads} upload dirs removed")
+            except Exception:
+                logger.exception("cleanup failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="cleanup", daemon=True)
+    thread.start()
+    return thread
 
 
-# ───────────────────────────── 4. START ────────────────────────────────────
+# ───────────────────────────── 5. START ────────────────────────────────────
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    ee.Initialize(opt_url="https://earthengine-highvolume.googleapis.com")
+
     models = [
         ParserPipeline(),
         CropperPipeline(),
@@ -340,6 +1433,35 @@ if __name__ == "__main__":
     if not models[-1].load():
         raise RuntimeError("CR-Net failed to load")
 
-    kserve.ModelServer(
+    # долгие запросы — фоновыми задачами, см. jobs.py
+    jobs = JobManager(
+        CONFIG.get("job_dir", str(Path(tempfile.gettempdir()) / "serve_jobs"))
+    )
+    parser, clouds = models[0], models[-1]
+    jobs.register(
+        parser.name, _profiled(parser.name, parser.run_payload),
+        CONFIG.get("parser_job_workers", 2), CONFIG.get("job_queue_size", 32),
+    )
+    jobs.register(
+        clouds.name, _profiled(clouds.name, clouds.run_payload),
+        CONFIG.get("clouds_job_workers", 1), CONFIG.get("job_queue_size", 32),
+    )
+    parser.jobs = clouds.jobs = jobs
+    for kind in (parser.name, clouds.name):
+        track_queue(f"jobs_{kind}", partial(jobs.pending, kind))
+    start_cleanup(
+        jobs, clouds,
+        CONFIG.get("result_ttl", 24 * 3600), CONFIG.get("cleanup_interval", 3600),
+    )
+
+    server = kserve.ModelServer(
         http_port=8100, enable_docs_url=True
-    ).start(models=models)
\ No newline at end of file
+    )
+    register_job_routes(rest_app, jobs, [parser, clouds])
+    # загрузка файлов multipart рядом с /v2/models/clouds/infer
+    rest_app.add_api_route(
+        f"/v2/models/{models[-1].name}/upload",
+        models[-1].upload,
+        methods=["POST"],
+    )
+    server.start(models=models)
\ No newline at end of file
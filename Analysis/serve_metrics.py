@@ -0,0 +1,122 @@
+"""
+Метрики serve.py в формате Prometheus.
+
+Метрики регистрируются в реестре prometheus_client по умолчанию, а его
+KServe уже отдаёт на ``GET /metrics`` — отдельный сервер не нужен.
+
+    serve_stage_seconds{stage}        — время стадий: raster_read, normalize,
+                                         forward, geotiff_write, ee_export, crop
+    serve_batch_size                  — размер батчей, ушедших в сеть
+    serve_queue_depth{queue}          — глубина очередей (батчер, фоновые задачи)
+    serve_memory_peak_bytes           — пиковый RSS процесса
+    serve_buffer_pool_bytes           — объём свободных буферов ввода
+
+Профилировщик: ``SamplingProfiler`` раз в ``interval`` секунд снимает
+стеки всех потоков процесса и сохраняет их в формате collapsed stacks
+(flamegraph.pl, speedscope). Включается на отдельный запрос, если это
+разрешено в конфигурации, но профиль получается общим на процесс:
+работа запроса идёт и в общих потоках (батчер, пулы ввода-вывода),
+поэтому параллельные запросы попадают в него тоже. Первый элемент
+каждого стека — имя потока.
+"""
+
+import collections
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from prometheus_client import Gauge, Histogram
+
+STAGE_SECONDS = Histogram(
+    "serve_stage_seconds",
+    "Время стадий обработки запроса",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180, 600),
+)
+BATCH_SIZE = Histogram(
+    "serve_batch_size",
+    "Число элементов в батче одного прохода сети",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+QUEUE_DEPTH = Gauge(
+    "serve_queue_depth",
+    "Элементов в очереди или в работе",
+    ["queue"],
+)
+MEMORY_PEAK = Gauge(
+    "serve_memory_peak_bytes",
+    "Пиковый RSS процесса",
+)
+# ru_maxrss — в килобайтах на Linux и в байтах на macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+MEMORY_PEAK.set_function(lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT)
+BUFFER_POOL = Gauge(
+    "serve_buffer_pool_bytes",
+    "Объём свободных float32-буферов в пуле ввода",
+)
+
+
+@contextmanager
+def stage(name):
+    """Замер стадии ``name`` в serve_stage_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+def track_queue(name, fn):
+    """Глубина очереди ``name`` — значение ``fn()`` на момент сбора метрик."""
+    QUEUE_DEPTH.labels(name).set_function(fn)
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик: фоновый поток раз в ``interval`` секунд
+    снимает стеки всех потоков процесса (``sys._current_frames``), а не
+    только потоков одного запроса, и считает одинаковые стеки. ``save``
+    пишет их в формате collapsed stacks.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
@@ -4,7 +4,9 @@ from datetime import datetime
 import os
 import tempfile
 import shutil
-import base64
+import json
+import hashlib
+import uuid
 import requests
 
 import parser_hub
@@ -12,6 +14,65 @@ import preprocessing as preproc
 import cropper
 import indicies
 
+INDEX_CACHE_DIR = os.environ.get("INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "index_cache"))
+KSERVE_URL = os.environ.get("KSERVE_URL", "http://localhost:8100")
+# каталог, смонтированный и у приложения, и у serve.py по одному пути:
+# снимки передаются на инференс путями, без пересылки по HTTP
+SHARED_DIR = os.environ.get("SHARED_DIR")
+
+
+def wait_job(job_id, poll=2.0):
+    """Ждёт фоновую задачу serve.py, показывая прогресс; возвращает её результат."""
+    bar = st.progress(0.0, text="В очереди")
+    while True:
+        job = requests.get(f"{KSERVE_URL}/v2/jobs/{job_id}", timeout=30).json()
+        if job["status"] == "failed":
+            raise RuntimeError(job["error"])
+        if job["status"] == "done":
+            bar.progress(1.0, text="Готово")
+            return requests.get(f"{KSERVE_URL}/v2/jobs/{job_id}/result", timeout=30).json()["result"]
+        done, total = job["progress"]["done"], job["progress"]["total"]
+        if job["status"] == "running" and total:
+            bar.progress(done / total, text=f"Обработано {done} из {total}")
+        time.sleep(poll)
+
+
+def clouds_infer_shared(aoi_file, s2_file, s1_file):
+    """Снимки кладутся в SHARED_DIR, обрезаются через VRT, на сервер уходят только пути."""
+    job_dir = os.path.join(SHARED_DIR, uuid.uuid4().hex)
+    os.makedirs(job_dir)
+    paths = {}
+    for key, uploaded in (("aoi", aoi_file), ("optical", s2_file), ("sar", s1_file)):
+        paths[key] = os.path.join(job_dir, f"{key}_{uploaded.name}")
+        with open(paths[key], "wb") as f:
+            f.write(uploaded.getbuffer())
+    for key in ("optical", "sar"):
+        paths[key] = cropper.clip_image(paths[key], paths["aoi"], os.path.splitext(paths[key])[0] + ".vrt", fmt="vrt")
+
+    payload = {"pairs": [{"optical": paths["optical"], "sar": paths["sar"]}], "save_dir": job_dir}
+    response = requests.post(f"{KSERVE_URL}/v2/models/clouds/jobs", json=payload, timeout=30)
+    if response.status_code != 202:
+        raise RuntimeError(response.text)
+    return wait_job(response.json()["job_id"])[0]
+
+
+def clouds_infer_upload(aoi_file, s2_file, s1_file):
+    """Файлы уходят на сервер как есть (multipart), инференс — фоновой задачей, ответ — готовый GeoTIFF."""
+    files = []
+    for key, uploaded, mime in (("aoi", aoi_file, "application/octet-stream"),
+                                ("optical", s2_file, "image/tiff"), ("sar", s1_file, "image/tiff")):
+        uploaded.seek(0)
+        files.append((key, (uploaded.name, uploaded, mime)))
+    response = requests.post(f"{KSERVE_URL}/v2/models/clouds/upload", files=files,
+                             data={"payload": json.dumps({"async": True})}, timeout=300)
+    if response.status_code != 202:
+        raise RuntimeError(response.text)
+    job_id = response.json()["job_id"]
+    wait_job(job_id)
+    response = requests.get(f"{KSERVE_URL}/v2/jobs/{job_id}/files/0", timeout=300)
+    response.raise_for_status()
+    return response.content
+
 def home_page():
     st.title("Главная страница")
 
@@ -71,7 +132,7 @@ with patch('builtins.input', side_effect=['{date.strftime('%Y-%m-%d')}', r'{tmp_
                     with open(s2_path, "wb") as f:
                         f.write(sentinel2_file.getbuffer())
                     output_s2 = os.path.join(temp_dir, "S2_resampled.tif")
-                    preproc.process_sentinel2(s2_path, output_s2)
+                    preproc.process_sentinel2(s2_path, output_s2, native=True)
                     st.success("Обработка Sentinel-2 завершена!")
                     with open(output_s2, "rb") as f:
                         st.download_button("⬇️ Сохранить как BigTiff для Sentinel-2", f, file_name="S2_resampled.tif")
@@ -139,49 +200,19 @@ with patch('builtins.input', side_effect=['{date.strftime('%Y-%m-%d')}', r'{tmp_
         if st.button("Запустить инференс"):
             if geo_file_inf and sentinel2_inf and sentinel1_inf:
                 with st.spinner("Отправка данных на KServe и ожидание ответа..."):
-                    temp_dir = tempfile.mkdtemp()
-
-                    aoi_path = os.path.join(temp_dir, geo_file_inf.name)
-                    with open(aoi_path, "wb") as f:
-                        f.write(geo_file_inf.getbuffer())
-                    with open(aoi_path, "rb") as f:
-                        aoi_bytes = f.read()
-                    aoi_b64 = base64.b64encode(aoi_bytes).decode("utf-8")
-
-                    s2_inf_path = os.path.join(temp_dir, sentinel2_inf.name)
-                    with open(s2_inf_path, "wb") as f:
-                        f.write(sentinel2_inf.getbuffer())
-                    with open(s2_inf_path, "rb") as f:
-                        s2_bytes = f.read()
-                    s2_b64 = base64.b64encode(s2_bytes).decode("utf-8")
-
-                    s1_inf_path = os.path.join(temp_dir, sentinel1_inf.name)
-                    with open(s1_inf_path, "wb") as f:
-                        f.write(sentinel1_inf.getbuffer())
-                    with open(s1_inf_path, "rb") as f:
-                        s1_bytes = f.read()
-                    s1_b64 = base64.b64encode(s1_bytes).decode("utf-8")
-
-                    payload = {
-                        "instances": [
-                            {
-                                "aoi": aoi_b64,
-                                "sentinel2": s2_b64,
-                                "sentinel1": s1_b64
-                            }
-                        ]
-                    }
-                    kserve_url = "http://localhost:8080/v1/models/my-model:predict"
                     try:
-                        response = requests.post(kserve_url, json=payload, timeout=300)
-                        response.raise_for_status()
-                        result = response.json().get("predictions", [])
-                        st.success("Инференс успешно выполнен!")
-                        st.json(result)
-                    except requests.exceptions.RequestException as e:
+                        if SHARED_DIR:
+                            pred_path = clouds_infer_shared(geo_file_inf, sentinel2_inf, sentinel1_inf)
+                            st.success("Инференс успешно выполнен!")
+                            st.write(f"Результат: {pred_path}")
+                            with open(pred_path, "rb") as f:
+                                st.download_button("⬇️ Скачать результат", f, file_name=os.path.basename(pred_path))
+                        else:
+                            pred = clouds_infer_upload(geo_file_inf, sentinel2_inf, sentinel1_inf)
+                            st.success("Инференс успешно выполнен!")
+                            st.download_button("⬇️ Скачать результат", pred, file_name="sentinel2_pred.tiff")
+                    except (requests.exceptions.RequestException, RuntimeError) as e:
                         st.error(f"Ошибка при обращении к KServe: {e}")
-
-                    shutil.rmtree(temp_dir)
             else:
                 st.warning("Пожалуйста, загрузите AOI и оба снимка перед инференсом.")
 
@@ -201,12 +232,21 @@ with patch('builtins.input', side_effect=['{date.strftime('%Y-%m-%d')}', r'{tmp_
                 with open(s2_idx_path, "wb") as f:
                     f.write(sentinel2_idx.getbuffer())
 
+                # хэш загруженных байтов считается один раз на файл и отдаётся
+                # кэшу индексов, чтобы тот не перечитывал GeoTIFF с диска
+                keys = st.session_state.setdefault("index_keys", {})
+                if sentinel2_idx.file_id not in keys:
+                    keys[sentinel2_idx.file_id] = hashlib.blake2b(
+                        sentinel2_idx.getbuffer(), digest_size=16
+                    ).hexdigest()
+
                 import sys
-                sys.argv = ['indices.py', s2_idx_path]
-                indices.main()
+                sys.argv = ['indicies.py', s2_idx_path, '--cache', INDEX_CACHE_DIR,
+                            '--key', keys[sentinel2_idx.file_id]]
+                indicies.main()
 
                 st.success("Расчет индексов завершен!")
-                for name in indices.INDEX_RANGES.keys():
+                for name in indicies.INDEX_RANGES.keys():
                     png_name = f"{name}_heatmap.png"
                     if os.path.exists(png_name):
                         with open(png_name, "rb") as f:
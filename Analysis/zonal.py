@@ -0,0 +1,107 @@
+import csv
+import sys
+
+import numpy as np
+import rasterio
+from rasterio.features import geometry_window, rasterize
+
+from cropper import aoi_geometries, read_features
+from indicies import INDEX_RANGES, IndexEngine
+
+PERCENTILES = (10, 25, 75, 90)
+
+
+def label_grid(geometries, shape, transform):
+    """
+    Растеризует все полигоны за один вызов: пиксель получает номер
+    полигона (с 1), 0 — вне полей. При перекрытии побеждает последний.
+    """
+    return rasterize(
+        ((geom, i) for i, geom in enumerate(geometries, start=1)),
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        dtype="int32",
+    )
+
+
+def group_stats(values, labels, n_labels, percentiles=PERCENTILES):
+    """
+    Статистики значений по меткам за один проход: count/mean через
+    bincount, медиана и перцентили — через сортировку по (метка, значение)
+    и линейную интерполяцию внутри групп, как в np.percentile.
+    Метка 0 и NaN пропускаются. Возвращает словарь массивов длины n_labels.
+    """
+    keep = (labels > 0) & ~np.isnan(values)
+    v = values[keep]
+    lab = labels[keep]
+
+    count = np.bincount(lab, minlength=n_labels + 1)[1:]
+    total = np.bincount(lab, weights=v, minlength=n_labels + 1)[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = {"count": count, "mean": total / count}
+
+    order = np.lexsort((v, lab))
+    v = v[order]
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+    empty = count == 0
+    last = np.maximum(count - 1, 0)
+
+    for q in (50,) + tuple(percentiles):
+        pos = start + last * (q / 100)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, start + last)
+        frac = pos - lo
+        if v.size:
+            res = v[np.minimum(lo, v.size - 1)] * (1 - frac) + v[np.minimum(hi, v.size - 1)] * frac
+        else:
+            res = np.zeros(n_labels)
+        res[empty] = np.nan
+        stats["median" if q == 50 else f"p{q}"] = res
+    return stats
+
+
+def zonal_stats(tif_path, aoi_path, names=None, formulas=None):
+    """
+    Статистики индексов по каждому полю AOI. Читается только окно,
+    покрывающее все поля, и только нужные индексам каналы.
+    Возвращает (имена полей, {индекс: {статистика: массив}}).
+    """
+    names = list(names or INDEX_RANGES)
+    engine = IndexEngine(names, formulas)
+    field_names = read_features(aoi_path)[0]
+
+    with rasterio.open(tif_path) as src:
+        geometries = aoi_geometries(aoi_path, src.crs)
+        window = geometry_window(src, geometries)
+        B = src.read([b + 1 for b in engine.bands], window=window)
+        transform = src.window_transform(window)
+        nodata = src.nodata
+
+    labels = label_grid(geometries, B.shape[1:], transform)
+    indices = engine.compute(B, bands=engine.bands, nodata=nodata)
+    del B
+
+    return field_names, {
+        name: group_stats(indices[name], labels, len(geometries))
+        for name in names
+    }
+
+
+def write_table(out_path, field_names, stats):
+    """Широкая таблица CSV: строка на поле, столбцы <индекс>_<статистика>."""
+    columns = [(name, key) for name, per_index in stats.items() for key in per_index]
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["field"] + [f"{name}_{key}" for name, key in columns])
+        for i, field in enumerate(field_names):
+            writer.writerow([field] + [stats[name][key][i] for name, key in columns])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Использование: python zonal.py <input_image> <input_aoi> <output_csv>")
+        sys.exit(1)
+    field_names, stats = zonal_stats(sys.argv[1], sys.argv[2])
+    write_table(sys.argv[3], field_names, stats)
+    print(f"Сохранено: {sys.argv[3]}")